@@ -1,46 +1,229 @@
 import shutil
 import sys
 import argparse
-from os import listdir
-from os.path import isfile, join
+import heapq
+import json
 import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-parser = argparse.ArgumentParser("merge")
-parser.add_argument("--input_folder", type=str, help="Path of input folder")
-parser.add_argument("--output_folder", type=str, help="Path of output folder")
-parser.add_argument("--merge_count", type=int, help="Path of output folder")
-
-args = parser.parse_args()
-
-input_folder = args.input_folder
-output_folder = args.output_folder
-merge_count = args.merge_count
-
-print("SystemLog: Reading from input folder %s"%args.input_folder)
-print("SystemLog: Reading from output folder %s"%args.output_folder)
-print("SystemLog: Merging every %d file together"%args.merge_count)
-sys.stdout.flush()
-
-total_files_processed = 0
-onlyfiles = [os.path.abspath(join(input_folder, f)) for f in listdir(input_folder) if isfile(join(input_folder, f))]
-total_files = len(onlyfiles)
-total_merges = int(math.ceil(total_files/merge_count))
-print("SystemLog: Total files in input_folder %d and total expected merged ones %d"% (total_files, total_merges))
-sys.stdout.flush()
-
-# This line should be added since in AzureML, output folder is not created.
-os.makedirs(output_folder, exist_ok=True)
-
-for merge_idx in range(total_merges):
-    merged_file = open(os.path.abspath(os.path.join(output_folder, str(merge_idx))), 'wb')
-    files_to_be_merged = onlyfiles[merge_idx * merge_count: (merge_idx + 1) * merge_count]
-    #print(files_to_be_merged)
-    for file_to_be_merged in files_to_be_merged:
-        shutil.copyfileobj(open(file_to_be_merged, 'rb'), merged_file)
-        total_files_processed += 1
-        if total_files_processed % 1000 == 0:
-            print("SystemLog: Total files processed %d"%total_files_processed)
-            sys.stdout.flush()
-print("Total files processed are %d and merged to %d files"%(total_files_processed, total_merges))
-sys.stdout.flush()
+# Bytes handed to a single copy_file_range/sendfile call, and buffer size of the fallback copy.
+ZERO_COPY_CHUNK_SIZE = 1 << 30
+COPY_BUFFER_SIZE = 1 << 20
+# Seconds between two progress logs.
+PROGRESS_INTERVAL = 10
+
+
+def log(message):
+    print("SystemLog: %s" % message)
+    sys.stdout.flush()
+
+
+def list_input_files(input_folder, group_by="name", with_sizes=True):
+    """
+    List the files (not folders) of input_folder as (absolute path, size) tuples in a deterministic order:
+    by file name, or by (size, file name) if group_by is "size".
+    scandir gives the file type from the directory listing, so that a stat per entry is only done for the sizes:
+    without with_sizes, which grouping by name and count doesn't need, the sizes are None and nothing is stat'ed.
+    """
+    if group_by not in ("name", "size"):
+        raise ValueError("Unknown group_by %s, expected name or size" % group_by)
+    with_sizes = with_sizes or group_by == "size"
+    with os.scandir(input_folder) as it:
+        files = [(os.path.abspath(entry.path), entry.name, entry.stat().st_size if with_sizes else None)
+                 for entry in it if entry.is_file()]
+    if group_by == "size":
+        files.sort(key=lambda f: (f[2], f[1]))
+    else:
+        files.sort(key=lambda f: f[1])
+    return [(path, size) for path, _, size in files]
+
+
+def group_by_count(files, merge_count):
+    """Split the ordered input files into consecutive groups of merge_count files."""
+    total_merges = int(math.ceil(len(files) / merge_count))
+    return [files[merge_idx * merge_count: (merge_idx + 1) * merge_count] for merge_idx in range(total_merges)]
+
+
+def group_by_target_bytes(files, target_bytes, max_files_per_output=0):
+    """
+    Bin-pack the input files into groups of roughly target_bytes each.
+    The number of groups is ceil(total size / target_bytes), or ceil(number of files / max_files_per_output)
+    if that is more; files are then assigned from the largest to the smallest to the currently smallest group
+    which is not full (greedy largest-first), which keeps the groups balanced in O(n log groups).
+    """
+    total_bytes = sum(size for _, size in files)
+    total_merges = max(1, int(math.ceil(total_bytes / target_bytes))) if files else 0
+    if max_files_per_output:
+        # all the groups are opened upfront, so that the extra ones needed by the cap get large files too
+        total_merges = max(total_merges, int(math.ceil(len(files) / max_files_per_output)))
+    groups = [[] for _ in range(total_merges)]
+    # (bytes in group, group index) so that ties go to the group created first, which keeps the result deterministic.
+    heap = [(0, merge_idx) for merge_idx in range(total_merges)]
+    for path, size in sorted(files, key=lambda f: (-f[1], f[0])):
+        group_bytes, merge_idx = heapq.heappop(heap)
+        groups[merge_idx].append((path, size))
+        if not max_files_per_output or len(groups[merge_idx]) < max_files_per_output:
+            heapq.heappush(heap, (group_bytes + size, merge_idx))
+    return groups
+
+
+def write_manifest(manifest_folder, groups):
+    """
+    Record which inputs went into each merged file, as one json line per merged file:
+    {"output": merged file name, "bytes": size, "inputs": [{"name": input file name, "offset": .., "bytes": ..}]}.
+    The offsets let downstream steps map a byte range of a merged file back to its source file.
+    """
+    os.makedirs(manifest_folder, exist_ok=True)
+    path = os.path.join(manifest_folder, "manifest.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        for merge_idx, files_to_be_merged in enumerate(groups):
+            inputs = []
+            offset = 0
+            for file_to_be_merged, size in files_to_be_merged:
+                inputs.append({"name": os.path.basename(file_to_be_merged), "offset": offset, "bytes": size})
+                offset += size
+            f.write(json.dumps({"output": str(merge_idx), "bytes": offset, "inputs": inputs}) + "\n")
+    log("Manifest written to %s" % path)
+
+
+def _zero_copy(source_fd, merged_fd):
+    """
+    Append the rest of source_fd to merged_fd in the kernel, with copy_file_range when available
+    (python 3.8+) and sendfile otherwise. Returns the number of bytes copied.
+    Raises OSError if neither is supported for this pair of files, the caller then falls back to a buffered copy.
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        while True:
+            n = os.copy_file_range(source_fd, merged_fd, ZERO_COPY_CHUNK_SIZE)
+            if n == 0:
+                return copied
+            copied += n
+    if hasattr(os, "sendfile"):
+        offset = os.lseek(source_fd, 0, os.SEEK_CUR)
+        try:
+            while True:
+                n = os.sendfile(merged_fd, source_fd, offset + copied, ZERO_COPY_CHUNK_SIZE)
+                if n == 0:
+                    return copied
+                copied += n
+        finally:
+            # sendfile with an explicit offset leaves the source offset untouched.
+            os.lseek(source_fd, offset + copied, os.SEEK_SET)
+    raise OSError("zero-copy is not supported on this platform")
+
+
+def append_file(source_path, merged_file):
+    """Append the content of source_path to the unbuffered merged_file, returns the number of bytes copied."""
+    with open(source_path, "rb", buffering=0) as source_file:
+        try:
+            return _zero_copy(source_file.fileno(), merged_file.fileno())
+        except OSError:
+            # e.g. cross-device copy_file_range or a filesystem without sendfile support.
+            # Bytes already copied have moved both file offsets, so resume from the current source position.
+            shutil.copyfileobj(source_file, merged_file, COPY_BUFFER_SIZE)
+            return source_file.tell()
+
+
+class ThroughputReporter:
+    """Thread-safe progress counter which logs throughput (MB/s, files/s) at most once every interval seconds."""
+
+    def __init__(self, total_files, interval=PROGRESS_INTERVAL):
+        self.total_files = total_files
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last_log = self._start
+
+    def update(self, files, num_bytes):
+        with self._lock:
+            self.files += files
+            self.bytes += num_bytes
+            now = time.time()
+            if now - self._last_log >= self.interval:
+                self._last_log = now
+                self._log(now)
+
+    def summary(self):
+        with self._lock:
+            self._log(time.time())
+
+    def _log(self, now):
+        elapsed = max(now - self._start, 1e-6)
+        log("Processed %d/%d files, %.2f MB in %.1f sec (%.2f MB/s, %.1f files/s)" % (
+            self.files, self.total_files, self.bytes / 2 ** 20, elapsed,
+            self.bytes / 2 ** 20 / elapsed, self.files / elapsed))
+
+
+def merge_group(merge_idx, files_to_be_merged, output_folder, progress):
+    path = os.path.abspath(os.path.join(output_folder, str(merge_idx)))
+    with open(path, "wb", buffering=0) as merged_file:
+        for file_to_be_merged, _ in files_to_be_merged:
+            progress.update(1, append_file(file_to_be_merged, merged_file))
+
+
+def merge(input_folder, output_folder, merge_count, group_by="name", num_workers=None,
+          target_bytes=0, max_files_per_output=0, manifest_folder=None):
+    # the sizes are only needed to group by bytes and for the offsets of the manifest
+    files = list_input_files(input_folder, group_by, with_sizes=bool(target_bytes or manifest_folder))
+    if target_bytes:
+        groups = group_by_target_bytes(files, target_bytes, max_files_per_output)
+    else:
+        groups = group_by_count(files, merge_count)
+    log("Total files in input_folder %d and total expected merged ones %d" % (len(files), len(groups)))
+
+    # This line should be added since in AzureML, output folder is not created.
+    os.makedirs(output_folder, exist_ok=True)
+
+    progress = ThroughputReporter(total_files=len(files))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(merge_group, merge_idx, files_to_be_merged, output_folder, progress)
+                   for merge_idx, files_to_be_merged in enumerate(groups)]
+        # Re-raise the first failure, if any.
+        for future in futures:
+            future.result()
+    progress.summary()
+    if manifest_folder:
+        write_manifest(manifest_folder, groups)
+    return progress.files, len(groups)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("merge")
+    parser.add_argument("--input_folder", type=str, help="Path of input folder")
+    parser.add_argument("--output_folder", type=str, help="Path of output folder")
+    parser.add_argument("--merge_count", type=int, default=100, help="Number of files merged together")
+    parser.add_argument("--group_by", type=str, default="name", choices=["name", "size"],
+                        help="Order used to group the input files, by file name or by file size")
+    parser.add_argument("--num_workers", type=int, default=min(8, os.cpu_count() or 1),
+                        help="Number of merged files written concurrently")
+    parser.add_argument("--target_bytes", type=int, default=0,
+                        help="If set, ignore merge_count and merge the input files into outputs of about this size")
+    parser.add_argument("--max_files_per_output", type=int, default=0,
+                        help="Maximum number of input files per output when target_bytes is set, 0 means no limit")
+    parser.add_argument("--manifest_folder", type=str, default=None,
+                        help="Path of the folder where the manifest of the merged files is written")
+
+    args = parser.parse_args()
+
+    log("Reading from input folder %s" % args.input_folder)
+    log("Reading from output folder %s" % args.output_folder)
+    if args.target_bytes:
+        log("Merging files into outputs of about %d bytes (at most %s files each), with %d workers" % (
+            args.target_bytes, args.max_files_per_output or "unlimited", args.num_workers))
+    else:
+        log("Merging every %d file together, grouped by %s, with %d workers" % (
+            args.merge_count, args.group_by, args.num_workers))
+
+    total_files_processed, total_merges = merge(args.input_folder, args.output_folder, args.merge_count,
+                                                group_by=args.group_by, num_workers=args.num_workers,
+                                                target_bytes=args.target_bytes,
+                                                max_files_per_output=args.max_files_per_output,
+                                                manifest_folder=args.manifest_folder)
+    print("Total files processed are %d and merged to %d files" % (total_files_processed, total_merges))
+    sys.stdout.flush()
@@ -0,0 +1,28 @@
+import sys
+import unittest
+from pathlib import Path
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from merge import group_by_target_bytes
+
+
+class TestGroupByTargetBytes(unittest.TestCase):
+
+    def test_balanced_groups(self):
+        files = [('file%d' % i, size) for i, size in enumerate([900, 700, 500, 400, 300, 200, 100, 100])]
+        groups = group_by_target_bytes(files, target_bytes=1000)
+        self.assertEqual(len(groups), 4)
+        self.assertEqual(sorted(path for group in groups for path, _ in group), sorted(path for path, _ in files))
+        sizes = [sum(size for _, size in group) for group in groups]
+        self.assertLessEqual(max(sizes) - min(sizes), 200)
+
+    def test_balanced_groups_with_max_files(self):
+        # the cap needs more groups than the total size, which all get a share of the large files
+        files = [('file%d' % i, size) for i, size in enumerate(range(10, 1001, 10))]
+        groups = group_by_target_bytes(files, target_bytes=30000, max_files_per_output=10)
+        self.assertEqual(len(groups), 10)
+        self.assertTrue(all(len(group) <= 10 for group in groups))
+        self.assertEqual(sorted(path for group in groups for path, _ in group), sorted(path for path, _ in files))
+        sizes = [sum(size for _, size in group) for group in groups]
+        self.assertLessEqual(max(sizes) - min(sizes), 500)
@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+import subprocess
+import unittest
+from pathlib import Path
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from walk import read_manifest
+
+WALK = str(Path(__file__).parent.parent / 'walk.py')
+
+
+class TestWalk(unittest.TestCase):
+
+    def run_walk(self, *args):
+        subprocess.run([sys.executable, WALK] + list(args), check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def test_empty_folder_then_incremental(self):
+        # an empty folder still gives a readable manifest, from which the next run detects the new files
+        for output_format in ('text', 'jsonl', 'parquet'):
+            with self.subTest(output_format=output_format), tempfile.TemporaryDirectory() as tmp_dir:
+                folder = os.path.join(tmp_dir, 'folder')
+                os.makedirs(folder)
+                manifest = os.path.join(tmp_dir, 'manifest.' + output_format)
+                self.run_walk('--path', folder, '--format', output_format, '--output', manifest)
+                self.assertEqual(read_manifest(manifest), {})
+
+                with open(os.path.join(folder, 'a.txt'), 'w') as f:
+                    f.write('a')
+                new_manifest = os.path.join(tmp_dir, 'new_manifest.' + output_format)
+                changes = os.path.join(tmp_dir, 'changes.' + output_format)
+                self.run_walk('--path', folder, '--format', output_format, '--output', new_manifest,
+                              '--previous_manifest', manifest, '--changes_output', changes)
+                self.assertEqual(list(read_manifest(new_manifest)), ['a.txt'])
+                self.assertEqual(read_manifest(changes)['a.txt']['status'], 'added')
+
+    def test_no_change_writes_empty_changes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            folder = os.path.join(tmp_dir, 'folder')
+            os.makedirs(folder)
+            with open(os.path.join(folder, 'a.txt'), 'w') as f:
+                f.write('a')
+            manifest = os.path.join(tmp_dir, 'manifest.parquet')
+            changes = os.path.join(tmp_dir, 'changes.parquet')
+            self.run_walk('--path', folder, '--format', 'parquet', '--output', manifest)
+            self.run_walk('--path', folder, '--format', 'parquet', '--previous_manifest', manifest,
+                          '--changes_output', changes)
+            self.assertEqual(read_manifest(changes), {})
@@ -1,18 +1,339 @@
-from os import walk
+import os
+import sys
+import json
+import hashlib
 import argparse
-from os import listdir
-from os.path import isfile, join
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os.path import isfile
 
-parser = argparse.ArgumentParser("walk")
-parser.add_argument("--path", type=str, help="Path of file/folder")
+FIELDS = ['size', 'mtime', 'hash']
+FORMATS = ['text', 'jsonl', 'parquet']
+CHANGE_STATUSES = ['added', 'changed', 'removed']
+HASH_CHUNK_SIZE = 1 << 20
+# Number of rows buffered before a parquet row group is written.
+PARQUET_BATCH_SIZE = 100000
+# pyarrow types of the record keys, so that a parquet file has the same schema whether it has records or not.
+PARQUET_TYPES = {'path': 'string', 'status': 'string', 'size': 'int64', 'mtime': 'float64', 'hash': 'string'}
 
-args = parser.parse_args()
 
-p = args.path
+def scan(root, recursive=False):
+    """
+    Yield the os.DirEntry of every file under root, in a deterministic (sorted by name) order.
+    The file type comes from the cached DirEntry information, so no extra stat is needed per entry,
+    and folders are walked depth first with an explicit stack so nothing is accumulated besides the current listing.
+    """
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        sub_folders = []
+        for entry in entries:
+            if entry.is_file():
+                yield entry
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                sub_folders.append(entry.path)
+        stack.extend(reversed(sub_folders))
 
-if (isfile(p)):
-    print(p)
-else:
-    onlyfiles = [f for f in listdir(p) if isfile(join(p, f))]
-    for f in onlyfiles:
-        print(f)
\ No newline at end of file
+
+def file_hash(path, algorithm='md5'):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _record(entry, root, fields):
+    record = {'path': os.path.relpath(entry.path, root).replace(os.sep, '/')}
+    if 'size' in fields or 'mtime' in fields:
+        stat = entry.stat()
+        if 'size' in fields:
+            record['size'] = stat.st_size
+        if 'mtime' in fields:
+            record['mtime'] = stat.st_mtime
+    return record
+
+
+def walk(root, recursive=False, fields=(), hash_algorithm='md5', num_workers=8):
+    """
+    Stream one record per file under root: {'path': path relative to root, and the optional 'size', 'mtime', 'hash'}.
+    Hashes are computed in a thread pool, with a bounded number of files in flight so that memory stays constant,
+    and records are still yielded in walk order.
+    """
+    if 'hash' not in fields:
+        for entry in scan(root, recursive):
+            yield _record(entry, root, fields)
+        return
+
+    max_in_flight = 4 * num_workers
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        in_flight = deque()
+        for entry in scan(root, recursive):
+            in_flight.append((_record(entry, root, fields), executor.submit(file_hash, entry.path, hash_algorithm)))
+            if len(in_flight) >= max_in_flight:
+                yield _with_hash(*in_flight.popleft())
+        while in_flight:
+            yield _with_hash(*in_flight.popleft())
+
+
+def _with_hash(record, future):
+    record['hash'] = future.result()
+    return record
+
+
+def record_keys(fields):
+    """Keys of the records walk yields for these fields, in their order."""
+    return ['path'] + [field for field in FIELDS if field in fields]
+
+
+class RecordWriter:
+    """
+    Write records one at a time to stdout (text or jsonl) or to a file (text, jsonl or parquet),
+    so that several outputs can be fed from a single walk.
+    A text file starts with a tab separated header of the record keys, so that read_manifest can parse it back.
+    With keys, the header of a text file and the schema of a parquet file are written even if there is no record,
+    otherwise they come from the first record.
+    """
+
+    def __init__(self, output=None, output_format='text', keys=None):
+        if output_format not in FORMATS:
+            raise ValueError('Unknown format %s, expected one of %s' % (output_format, ','.join(FORMATS)))
+        if output_format == 'parquet' and not output:
+            raise ValueError('parquet output requires an output path')
+        self.output = output
+        self.output_format = output_format
+        self.keys = list(keys) if keys is not None else None
+        self.count = 0
+        self._batch = []
+        self._parquet_writer = None
+        self._header_written = False
+        if output_format != 'parquet':
+            self._f = open(output, 'w', encoding='utf-8') if output else sys.stdout
+            if output_format == 'text' and self.keys is not None:
+                self._write_header(self.keys)
+
+    def _write_header(self, keys):
+        if self.output:
+            self._f.write('\t'.join(keys) + '\n')
+        self._header_written = True
+
+    def write(self, record):
+        self.count += 1
+        if self.output_format == 'parquet':
+            self._batch.append(record)
+            if len(self._batch) >= PARQUET_BATCH_SIZE:
+                self._flush_parquet()
+        elif self.output_format == 'jsonl':
+            self._f.write(json.dumps(record) + '\n')
+        else:
+            if not self._header_written:
+                self._write_header(record)
+            self._f.write('\t'.join(str(value) for value in record.values()) + '\n')
+
+    def _flush_parquet(self):
+        # pyarrow is only needed for the parquet output.
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        keys = self.keys
+        if keys is None:
+            if not self._batch:
+                # neither keys nor records to take the schema from
+                return
+            keys = list(self._batch[0])
+        schema = pa.schema([(key, PARQUET_TYPES.get(key, 'string')) for key in keys])
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.output, schema)
+        if self._batch:
+            table = pa.Table.from_pydict({key: [record.get(key) for record in self._batch] for key in keys},
+                                         schema=schema)
+            self._parquet_writer.write_table(table)
+        self._batch = []
+
+    def close(self):
+        if self.output_format == 'parquet':
+            if self._batch or self._parquet_writer is None:
+                # without records, this still creates the file from keys
+                self._flush_parquet()
+            if self._parquet_writer is not None:
+                self._parquet_writer.close()
+        elif self.output:
+            self._f.close()
+        else:
+            self._f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write(records, output=None, output_format='text', keys=None):
+    """Write the records as they are produced, returns the number of records written."""
+    with RecordWriter(output, output_format, keys) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.count
+
+
+# Types of the fields in a text manifest, where every value is written as a string.
+FIELD_TYPES = {'size': int, 'mtime': float, 'hash': str}
+
+
+def _read_text_records(f):
+    """Records of a text manifest, whose first line is the header written by RecordWriter."""
+    keys = f.readline().rstrip('\n').split('\t')
+    if keys[0] != 'path':
+        raise ValueError('Text manifest without header, it was not written by this module to a file')
+    for line in f:
+        if line.strip():
+            values = line.rstrip('\n').split('\t')
+            yield {key: FIELD_TYPES.get(key, str)(value) for key, value in zip(keys, values)}
+
+
+def read_manifest(path):
+    """
+    Load a manifest written by a previous walk (text, jsonl or parquet, or a folder containing
+    manifest.text/jsonl/parquet) as a dict from relative path to record.
+    """
+    if os.path.isdir(path):
+        candidates = [os.path.join(path, 'manifest.' + output_format) for output_format in ('jsonl', 'parquet', 'text')]
+        candidates = [candidate for candidate in candidates if isfile(candidate)]
+        if not candidates:
+            raise FileNotFoundError('No manifest.jsonl, manifest.parquet or manifest.text in %s' % path)
+        path = candidates[0]
+    if path.endswith('.text'):
+        with open(path, 'r', encoding='utf-8') as f:
+            return {record['path']: record for record in _read_text_records(f)}
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        columns = pq.read_table(path).to_pydict()
+        keys = list(columns)
+        records = (dict(zip(keys, values)) for values in zip(*(columns[key] for key in keys)))
+        return {record['path']: record for record in records}
+    with open(path, 'r', encoding='utf-8') as f:
+        records = (json.loads(line) for line in f if line.strip())
+        return {record['path']: record for record in records}
+
+
+def compare_fields(compare_by):
+    """Fields a manifest needs for a later run to compare files by compare_by."""
+    return ['hash'] if compare_by == 'hash' else ['size', 'mtime']
+
+
+def check_manifest_fields(previous, compare_by):
+    """Raise a ValueError if the records of a previous manifest lack the fields compare_by needs."""
+    required_fields = compare_fields(compare_by)
+    for record in previous.values():
+        missing = [field for field in required_fields if field not in record]
+        if missing:
+            raise ValueError('The previous manifest has no %s field (e.g. for %s), which compare_by=%s needs: '
+                             'it was written without them, walk again without previous_manifest to rebuild it'
+                             % (','.join(missing), record['path'], compare_by))
+
+
+def _is_changed(record, previous_record, compare_by):
+    if compare_by == 'hash':
+        return record.get('hash') != previous_record.get('hash')
+    return record.get('size') != previous_record.get('size') or record.get('mtime') != previous_record.get('mtime')
+
+
+def diff(records, previous, compare_by='mtime'):
+    """
+    Compare the walked records against the previous manifest, which is consumed.
+    Yield (record, status) for every current file, status being 'added', 'changed' or 'unchanged',
+    then (record, 'removed') for the files of the previous manifest which are gone.
+    Files are compared by size and mtime, or by content hash if compare_by is 'hash'.
+    """
+    for record in records:
+        previous_record = previous.pop(record['path'], None)
+        if previous_record is None:
+            yield record, 'added'
+        elif _is_changed(record, previous_record, compare_by):
+            yield record, 'changed'
+        else:
+            yield record, 'unchanged'
+    for path in sorted(previous):
+        yield previous[path], 'removed'
+
+
+def parse_fields(value):
+    fields = [field.strip() for field in value.split(',') if field.strip()] if value else []
+    for field in fields:
+        if field not in FIELDS:
+            raise argparse.ArgumentTypeError('Unknown field %s, expected some of %s' % (field, ','.join(FIELDS)))
+    return fields
+
+
+def output_file(output, name, output_format):
+    if output and (os.path.isdir(output) or not os.path.splitext(output)[1]):
+        # In AzureML, the output is a folder which is not created.
+        os.makedirs(output, exist_ok=True)
+        return os.path.join(output, '%s.%s' % (name, output_format))
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("walk")
+    parser.add_argument("--path", type=str, help="Path of file/folder")
+    parser.add_argument("--recursive", type=lambda x: str(x).lower() == 'true', default=False,
+                        help="Whether to walk sub folders")
+    parser.add_argument("--fields", type=parse_fields, default=[],
+                        help="Comma separated optional fields: size, mtime, hash")
+    parser.add_argument("--hash_algorithm", type=str, default='md5', help="hashlib algorithm of the hash field")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of threads computing hashes")
+    parser.add_argument("--format", type=str, default='text', choices=FORMATS,
+                        help="Output format")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Path of the output file, or of a folder to write manifest.<format> into. "
+                             "Print to stdout if not set")
+    parser.add_argument("--previous_manifest", type=str, default=None,
+                        help="Manifest of a previous walk. If set, only the added, changed and removed files "
+                             "are written to --changes_output")
+    parser.add_argument("--compare_by", type=str, default='mtime', choices=['mtime', 'hash'],
+                        help="Decide whether a file changed by size and mtime, or by content hash")
+    parser.add_argument("--changes_output", type=str, default=None,
+                        help="Path of the changes file, or of a folder to write changes.<format> into. "
+                             "Print to stdout if not set")
+
+    args = parser.parse_args()
+
+    p = args.path
+    output = output_file(args.output, 'manifest', args.format)
+
+    # The fields needed for the comparison are always recorded in a manifest, so that it can serve the next run.
+    fields = args.fields
+    if output:
+        fields = fields + [field for field in compare_fields(args.compare_by) if field not in fields]
+
+    if (isfile(p)):
+        print(p)
+    elif not args.previous_manifest:
+        records = walk(p, recursive=args.recursive, fields=fields,
+                       hash_algorithm=args.hash_algorithm, num_workers=args.num_workers)
+        write(records, output, args.format, keys=record_keys(fields))
+    else:
+        fields = fields + [field for field in compare_fields(args.compare_by) if field not in fields]
+        previous = read_manifest(args.previous_manifest)
+        check_manifest_fields(previous, args.compare_by)
+        records = walk(p, recursive=args.recursive, fields=fields,
+                       hash_algorithm=args.hash_algorithm, num_workers=args.num_workers)
+        changes_output = output_file(args.changes_output, 'changes', args.format)
+        counts = {status: 0 for status in CHANGE_STATUSES + ['unchanged']}
+        # Without --output, only the changes are written, to stdout.
+        with RecordWriter(changes_output, args.format, keys=['path', 'status'] + fields) as changes_writer:
+            manifest_writer = RecordWriter(output, args.format, keys=record_keys(fields)) if output else None
+            for record, status in diff(records, previous, args.compare_by):
+                counts[status] += 1
+                if manifest_writer and status != 'removed':
+                    manifest_writer.write(record)
+                if status != 'unchanged':
+                    changes_writer.write({'path': record['path'], 'status': status,
+                                          **{field: record.get(field) for field in fields}})
+            if manifest_writer:
+                manifest_writer.close()
+        print('SystemLog: %s' % ', '.join('%d %s' % (count, status) for status, count in counts.items()),
+              file=sys.stderr)
@@ -0,0 +1,65 @@
+"""
+Compare the files/sec of the fastText parallel score path on CPU: one forward pass per file (before)
+and score_files, which reads the files with a thread pool and scores them in large batches (after).
+
+    python benchmarks/benchmark_batch_scoring.py --num_files 1000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+import torch
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from common.FastText import FastText
+from common.utils import DataIter, load_dataset, predict_parallel, score_files
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark_batch_scoring")
+    parser.add_argument("--num_files", type=int, default=1000)
+    parser.add_argument("--vocab_size", type=int, default=50000)
+    parser.add_argument("--max_len", type=int, default=32)
+    parser.add_argument("--ngram_size", type=int, default=200000)
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--num_io_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    word_to_index = {'[PAD]': 0, '[UNK]': 1}
+    word_to_index.update({'w%d' % i: i + 2 for i in range(args.vocab_size)})
+    map_id_label = {i: str(i) for i in range(10)}
+    model = FastText(vocab_size=len(word_to_index), class_num=10, ngram_size=args.ngram_size)
+    model.eval()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in range(args.num_files):
+            path = os.path.join(tmp, '%d.txt' % i)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(' '.join('w%d' % random.randrange(args.vocab_size) for _ in range(random.randint(1, 40))))
+            files.append(path)
+
+        start = time.time()
+        with torch.no_grad():
+            samples = load_dataset(files, word_to_index, {}, args.max_len, args.ngram_size)
+            before = predict_parallel(model, DataIter(samples, batch_size=1, shuffle=False), map_id_label)
+        before_time = time.time() - start
+
+        start = time.time()
+        after, probabilities = score_files(model, files, word_to_index, map_id_label, args.max_len, args.ngram_size,
+                                           batch_size=args.batch_size, num_workers=args.num_io_workers)
+        after_time = time.time() - start
+
+    print(f'files: {args.num_files}, threads: {torch.get_num_threads()}')
+    print(f'batch of 1: {args.num_files / before_time:.0f} files/sec')
+    print(f'batch of {args.batch_size}: {args.num_files / after_time:.0f} files/sec ({before_time / after_time:.1f}x)')
+    print(f'identical classes: {before == after}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Compare the CPU throughput (samples/sec) of FastText and FastTextBag, for inference and for a training step,
+and check that both give the same outputs with the same weights.
+
+    python benchmarks/benchmark_embedding_bag.py --batch_size 256 --max_len 32
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from common.FastText import FastText, FastTextBag
+from common.utils import ngram_hashes
+
+
+def make_batch(batch_size, max_len, vocab_size, ngram_size):
+    lengths = np.random.randint(1, max_len + 1, size=batch_size)
+    ids = np.random.randint(2, vocab_size, size=(batch_size, max_len))
+    ids[np.arange(max_len) >= lengths[:, None]] = 0
+    bigram, trigram = ngram_hashes(ids, ngram_size)
+    return tuple(torch.from_numpy(array) for array in (ids, bigram, trigram))
+
+
+def throughput(model, batch, steps, training):
+    y = torch.randint(0, model.fc2.out_features, (batch[0].shape[0],))
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    loss = torch.nn.CrossEntropyLoss()
+    model.train(training)
+    start = time.time()
+    for _ in range(steps):
+        if training:
+            optimizer.zero_grad()
+            loss(model(batch), y).backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model(batch)
+    return steps * batch[0].shape[0] / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark_embedding_bag")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--max_len", type=int, default=32)
+    parser.add_argument("--vocab_size", type=int, default=50000)
+    parser.add_argument("--ngram_size", type=int, default=200000)
+    parser.add_argument("--embed_dim", type=int, default=300)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--pooling", type=str, default='mean', choices=['mean', 'masked_mean'])
+    args = parser.parse_args()
+
+    model = FastText(vocab_size=args.vocab_size, class_num=10, embed_dim=args.embed_dim,
+                     ngram_size=args.ngram_size, pooling=args.pooling)
+    bag = FastTextBag.from_fasttext(model)
+    batch = make_batch(args.batch_size, args.max_len, args.vocab_size, args.ngram_size)
+
+    model.eval()
+    bag.eval()
+    with torch.no_grad():
+        max_diff = (model(batch) - bag(batch)).abs().max().item()
+    print(f'threads: {torch.get_num_threads()}, batch_size: {args.batch_size}, max_len: {args.max_len}')
+    print(f'max abs output difference: {max_diff:.2e}')
+    for training in (False, True):
+        mode = 'train step' if training else 'inference'
+        embedding = throughput(model, batch, args.steps, training)
+        embedding_bag = throughput(bag, batch, args.steps, training)
+        print(f'{mode}: FastText {embedding:.0f} samples/sec, FastTextBag {embedding_bag:.0f} samples/sec '
+              f'({embedding_bag / embedding:.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
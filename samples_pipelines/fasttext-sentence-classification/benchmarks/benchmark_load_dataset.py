@@ -0,0 +1,118 @@
+"""
+Compare the load time of a synthetic corpus with the original load_dataset (before), copied below as it was:
+per-line split, vocabulary lookup and python n-gram hashing one position at a time,
+and the vectorised load_dataset of common.utils (after), and check that both give the same samples.
+
+    python benchmarks/benchmark_load_dataset.py --num_sentences 1000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+from tqdm import tqdm
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from common.utils import load_dataset
+
+
+def make_corpus(path, num_sentences, vocab_size, class_num, max_sentence_len, seed=0):
+    rng = random.Random(seed)
+    words = ['w%d' % i for i in range(vocab_size)]
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(num_sentences):
+            text = ' '.join(rng.choice(words) for _ in range(rng.randint(1, max_sentence_len)))
+            f.write('%s\t%d\n' % (text, rng.randrange(class_num)))
+    word_to_index = {'[PAD]': 0, '[UNK]': 1}
+    word_to_index.update({word: i + 2 for i, word in enumerate(words)})
+    map_label_id = {str(i): i for i in range(class_num)}
+    return word_to_index, map_label_id
+
+
+# The previous implementation of common.utils, unchanged: one python call per line, word and n-gram position.
+def get_bigram_hash(text, index, ngram_size):
+    word1 = text[index - 1] if index - 1 >= 0 else 0
+    return (word1 * 10600202) % ngram_size
+
+
+def get_trigram_hash(sequence, index, ngram_size):
+    word1 = sequence[index - 1] if index - 1 >= 0 else 0
+    word2 = sequence[index - 2] if index - 2 >= 0 else 0
+    return (word2 * 10600202 * 13800202 + word1 * 10600202) % ngram_size
+
+
+def load_dataset_before(file_path, word_to_index, map_label_id, max_len=32, ngram_size=200000):
+    # [PAD]:0    [UNK]:1
+    pad_id = word_to_index.get('[PAD]', 0)
+    samples = []
+    # load dataset for batch inference
+    if isinstance(file_path, list):
+        lines = []
+        for file in file_path:
+            with open(file, 'r', encoding='utf-8') as f:
+                # 0 is the dummy label and doesn't work
+                text = f.read().strip()
+                if len(text) > 0:
+                    lines.append(text + '\t' + '0')
+    # load dataset for pipeline
+    else:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            lines = f.read().split("\n")
+            lines = [line.strip() for line in lines if len(line) > 0]
+    for line in tqdm(lines, desc="load data"):
+        line = line.split('\t')
+        text = line[0].split(' ')
+        label = line[1]
+        # [UNK]:1
+        text = ([word_to_index.get(word, 1) for word in text]) + [pad_id] * (max_len - len(text))
+        text = text[:max_len]
+        samples.append(process_data_before(text, label, max_len, ngram_size, map_label_id))
+    return samples
+
+
+def process_data_before(text: list, label: str, max_len=32, ngram_size=200000, map_label_id=None):
+    bigram = []
+    trigram = []
+    id_ = None
+    for i in range(max_len):
+        bigram.append(get_bigram_hash(text, i, ngram_size))
+        trigram.append(get_trigram_hash(text, i, ngram_size))
+        # label not in map_label_id when inference
+        id_ = map_label_id[label] if label in map_label_id else 0
+    return (text, bigram, trigram, id_)
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark_load_dataset")
+    parser.add_argument("--num_sentences", type=int, default=1000000)
+    parser.add_argument("--vocab_size", type=int, default=50000)
+    parser.add_argument("--class_num", type=int, default=10)
+    parser.add_argument("--max_len", type=int, default=32)
+    parser.add_argument("--ngram_size", type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data.txt')
+        word_to_index, map_label_id = make_corpus(path, args.num_sentences, args.vocab_size, args.class_num,
+                                                  max_sentence_len=args.max_len * 2)
+        start = time.time()
+        before = load_dataset_before(path, word_to_index, map_label_id, args.max_len, args.ngram_size)
+        before_time = time.time() - start
+        start = time.time()
+        after = load_dataset(path, word_to_index, map_label_id, args.max_len, args.ngram_size)
+        after_time = time.time() - start
+
+    # the whole (ids, bigram, trigram, label) samples, so that the tokenisation is compared too
+    mismatches = sum(tuple(b) != tuple(a) for b, a in zip(before, after)) + abs(len(before) - len(after))
+    print(f'sentences: {args.num_sentences}')
+    print(f'original load_dataset: {before_time:.2f} sec')
+    print(f'vectorised load_dataset: {after_time:.2f} sec ({before_time / after_time:.1f}x)')
+    print(f'identical samples: {mismatches == 0} ({mismatches} different)')
+
+
+if __name__ == '__main__':
+    main()
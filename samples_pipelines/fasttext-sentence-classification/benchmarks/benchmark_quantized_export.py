@@ -0,0 +1,71 @@
+"""
+Compare the exports of a trained model directory (the output of fasttext_train): BestModel, the TorchScript model
+and the quantized TorchScript model, by file size, load time, cpu scoring throughput and accuracy on a test dataset,
+and report how many predictions of each export agree with BestModel.
+
+    python benchmarks/benchmark_quantized_export.py --model_dir trained_model_dir --test_data_dir test_data_dir
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+import torch
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from common.checkpoint import load_model
+from common.utils import DataIter, get_vocab, get_id_label, load_data_dir, predict_proba, TORCHSCRIPT_MODEL, \
+    QUANTIZED_MODEL
+
+
+def timed_load(load, path, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        model = load(path)
+    return model, (time.time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark_quantized_export")
+    parser.add_argument("--model_dir", type=str, help="Output folder of fasttext_train")
+    parser.add_argument("--test_data_dir", type=str, help="Folder with data.txt, word_to_index.json and label.txt")
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--load_repeat", type=int, default=3, help="Number of loads the load time is averaged over")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.model_dir, 'shared_params.json'), 'r', encoding='utf-8') as f:
+        shared_params = json.load(f)
+    word_to_index = get_vocab(os.path.join(args.test_data_dir, 'word_to_index.json'))
+    _, map_label_id = get_id_label(os.path.join(args.test_data_dir, 'label.txt'))
+    samples = load_data_dir(args.test_data_dir, word_to_index, map_label_id, max_len=shared_params['max_len'],
+                            ngram_size=shared_params['ngram_size'])
+    labels = torch.as_tensor(samples.labels)
+
+    exports = [('BestModel', lambda path: load_model(path, map_location='cpu')),
+               (TORCHSCRIPT_MODEL, lambda path: torch.jit.load(path, map_location='cpu')),
+               (QUANTIZED_MODEL, lambda path: torch.jit.load(path, map_location='cpu'))]
+    reference = None
+    print(f'{len(samples)} test samples, threads: {torch.get_num_threads()}')
+    for name, load in exports:
+        path = os.path.join(args.model_dir, name)
+        if not os.path.isfile(path):
+            print(f'{name}: not found')
+            continue
+        model, load_time = timed_load(load, path, args.load_repeat)
+        start = time.time()
+        predictions, _ = predict_proba(model, DataIter(samples, batch_size=args.batch_size, shuffle=False))
+        samples_per_sec = len(samples) / (time.time() - start)
+        predictions = torch.as_tensor(predictions)
+        if reference is None:
+            reference = predictions
+        acc = (predictions == labels).double().mean().item()
+        agreement = (predictions == reference).double().mean().item()
+        print(f'{name}: {os.path.getsize(path) / 2 ** 20:.1f} MB, load {load_time * 1000:.0f} ms, '
+              f'{samples_per_sec:.0f} samples/sec, acc {acc:.4f}, agreement with BestModel {agreement:.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Compare the CPU training throughput (samples/sec) and the test accuracy of the fasttext_train options:
+dense vs sparse n-gram embeddings with SparseAdam (sparse_ngrams), for a list of intra-op thread counts, on a synthetic corpus where the class of a sentence depends on its words.
+
+    python benchmarks/benchmark_training_modes.py --num_threads 1,4,8 --epochs 2
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from common.FastText import FastText, FastTextBag
+from common.utils import ArrayDataset, DataIter, ngram_hashes, build_optimizers, evaluation
+
+
+def make_corpus(num_samples, max_len, vocab_size, ngram_size, class_num, topic_words, seed):
+    """
+    Sentences whose words are drawn from the topic_words words of their class half of the time,
+    and uniformly from the vocab otherwise.
+    """
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, class_num, size=num_samples)
+    own_words = 2 + labels[:, None] * topic_words + rng.randint(0, topic_words, size=(num_samples, max_len))
+    any_words = rng.randint(2, vocab_size, size=(num_samples, max_len))
+    ids = np.where(rng.rand(num_samples, max_len) < 0.5, own_words, any_words)
+    lengths = rng.randint(1, max_len + 1, size=num_samples)
+    ids[np.arange(max_len) >= lengths[:, None]] = 0
+    bigram, trigram = ngram_hashes(ids, ngram_size)
+    return ArrayDataset(ids, bigram, trigram, labels.astype(np.int64))
+
+
+def run(args, train_set, test_set, num_threads, sparse_ngrams):
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(1)
+    model_class = FastTextBag if args.embedding_bag else FastText
+    model = model_class(vocab_size=args.vocab_size, class_num=args.class_num, embed_dim=args.embed_dim,
+                        hidden_size=args.hidden_size, ngram_size=args.ngram_size, sparse_ngrams=sparse_ngrams)
+    optimizers = build_optimizers(model, args.learning_rate)
+    loss = torch.nn.CrossEntropyLoss()
+    model.train()
+    samples = 0
+    start = time.time()
+    for _ in range(args.epochs):
+        for batch_x, batch_y in DataIter(train_set, batch_size=args.batch_size, shuffle=True):
+            loss_value = loss(model(batch_x), batch_y)
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            loss_value.backward()
+            for optimizer in optimizers:
+                optimizer.step()
+            samples += len(batch_y)
+    samples_per_sec = samples / (time.time() - start)
+    _, acc, _, _, _ = evaluation(model, DataIter(test_set, batch_size=1024, shuffle=False))
+    return samples_per_sec, acc
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark_training_modes")
+    parser.add_argument("--num_samples", type=int, default=50000)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--max_len", type=int, default=32)
+    parser.add_argument("--vocab_size", type=int, default=50000)
+    parser.add_argument("--ngram_size", type=int, default=200000)
+    parser.add_argument("--embed_dim", type=int, default=300)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--class_num", type=int, default=10)
+    parser.add_argument("--topic_words", type=int, default=100, help="Number of words specific to each class")
+    parser.add_argument("--learning_rate", type=float, default=0.001)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--embedding_bag", action='store_true', help="Benchmark FastTextBag instead of FastText")
+    parser.add_argument("--num_threads", type=str, default=str(torch.get_num_threads()),
+                        help="Comma separated intra-op thread counts")
+    args = parser.parse_args()
+
+    train_set = make_corpus(args.num_samples, args.max_len, args.vocab_size, args.ngram_size, args.class_num,
+                            args.topic_words, 0)
+    test_set = make_corpus(args.num_samples // 10, args.max_len, args.vocab_size, args.ngram_size, args.class_num,
+                           args.topic_words, 1)
+    for num_threads in [int(n) for n in args.num_threads.split(',')]:
+        baseline = None
+        for sparse_ngrams in (False, True):
+            samples_per_sec, acc = run(args, train_set, test_set, num_threads, sparse_ngrams)
+            if baseline is None:
+                baseline = (samples_per_sec, acc)
+            mode = 'sparse' if sparse_ngrams else 'dense'
+            print(f'threads:{num_threads} {mode}: {samples_per_sec:.0f} samples/sec '
+                  f'({samples_per_sec / baseline[0]:.2f}x) test acc:{acc:.4f} (delta {acc - baseline[1]:+.4f})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+
+import torch
+import torch.distributed as dist
+
+# (rank, world size) environment variables of the launchers: torchrun / tools/launch_local.py, Open MPI, Intel MPI.
+RANK_ENV_VARS = [('RANK', 'WORLD_SIZE'), ('OMPI_COMM_WORLD_RANK', 'OMPI_COMM_WORLD_SIZE'), ('PMI_RANK', 'PMI_SIZE')]
+LOCAL_WORLD_SIZE_ENV_VARS = ['LOCAL_WORLD_SIZE', 'OMPI_COMM_WORLD_LOCAL_SIZE', 'MPI_LOCALNRANKS']
+DEFAULT_MASTER_PORT = '29500'
+
+
+def _rank_and_world_size():
+    for rank_var, size_var in RANK_ENV_VARS:
+        if rank_var in os.environ and size_var in os.environ:
+            return int(os.environ[rank_var]), int(os.environ[size_var])
+    return 0, 1
+
+
+def init_distributed(backend='gloo'):
+    """
+    Initialize torch.distributed from the environment of the launcher, returns (rank, world_size).
+    A single process, e.g. a plain python run, gets (0, 1) and no process group.
+    In AzureML MPI jobs, the master address comes from AZ_BATCH_MASTER_NODE (ip:port) on multiple nodes,
+    and is the local host otherwise.
+    """
+    rank, world_size = _rank_and_world_size()
+    if world_size <= 1 or is_distributed():
+        return rank, world_size
+    master_node = os.environ.get('AZ_BATCH_MASTER_NODE', os.environ.get('AZ_BATCHAI_MPI_MASTER_NODE', ''))
+    master_addr, _, master_port = master_node.partition(':')
+    os.environ.setdefault('MASTER_ADDR', master_addr or '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', master_port or DEFAULT_MASTER_PORT)
+    dist.init_process_group(backend=backend, init_method='env://', rank=rank, world_size=world_size)
+    print(f'initialized {backend} process group: rank {rank}/{world_size}, '
+          f"master {os.environ['MASTER_ADDR']}:{os.environ['MASTER_PORT']}")
+    return rank, world_size
+
+
+def get_local_world_size():
+    """Number of processes on this node, according to the launcher, 1 if unknown."""
+    for var in LOCAL_WORLD_SIZE_ENV_VARS:
+        if var in os.environ:
+            return int(os.environ[var])
+    return 1
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(tensor):
+    """Sum tensor over all the processes, in place, and return it; no-op in a single process."""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def shard_dataset(dataset, rank, world_size, drop_last=True):
+    """
+    The rank-th of world_size interleaved shards of an ArrayDataset, as a view when the arrays are memory-mapped.
+    With drop_last, the samples left over by the division are dropped so that every shard has the same length:
+    data-parallel training needs the same number of batches on every process, otherwise gradient
+    synchronisation would wait forever for the ranks which ran out of batches.
+    """
+    end = len(dataset) // world_size * world_size if drop_last else len(dataset)
+    return type(dataset)(*[getattr(dataset, field)[rank:end:world_size] for field in dataset.FIELDS])
+
+
+def unwrap_model(model):
+    """The model wrapped by DistributedDataParallel, to save or evaluate it without gradient synchronisation."""
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where publish falls back to hard links and copies
+    fcntl = None
+
+# ioctl of linux/fs.h which clones a file as copy-on-write extents (btrfs, xfs, overlayfs on them, ...)
+FICLONE = 0x40049409
+
+
+def file_hash(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def same_content(src, dst):
+    """Whether dst is a file with the same content as src: the same file, or the same size and sha256."""
+    if not os.path.isfile(dst):
+        return False
+    if os.path.samefile(src, dst):
+        return True
+    return os.path.getsize(src) == os.path.getsize(dst) and file_hash(src) == file_hash(dst)
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError('reflink is not supported on this platform')
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _link_or_copy(src, dst):
+    for method, link in (('reflink', reflink), ('hardlink', os.link)):
+        try:
+            link(src, dst)
+            return method
+        except OSError:
+            # e.g. a file system without reflinks, or src and dst on different mounts
+            if os.path.lexists(dst):
+                os.remove(dst)
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def publish(src, dst):
+    """
+    Make dst a file with the content of src, dst being a file path or a directory to publish into under
+    the name of src, with the cheapest available method: a reflink, then a hard link, then a copy.
+    An existing dst with the same content is kept. Otherwise the file is published under a temporary name and
+    renamed, so that dst is never partial. A published file may share its storage with src, so it must not be
+    modified in place afterwards, only replaced.
+    Returns the method used: 'unchanged', 'reflink', 'hardlink' or 'copy'.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if same_content(src, dst):
+        return 'unchanged'
+    tmp_dst = f'{dst}.tmp{os.getpid()}'
+    if os.path.lexists(tmp_dst):
+        os.remove(tmp_dst)
+    method = _link_or_copy(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+    return method
+
+
+def publish_files(src_dir, dst_dir, names, optional=False):
+    """
+    publish the files names of src_dir into dst_dir, skipping the missing ones if optional, and print how.
+    Returns {name: method}.
+    """
+    methods = {}
+    for name in names:
+        src = os.path.join(src_dir, name)
+        if optional and not os.path.isfile(src):
+            continue
+        methods[name] = publish(src, dst_dir)
+        print(f'publish {src} -> {dst_dir}: {methods[name]}')
+    return methods
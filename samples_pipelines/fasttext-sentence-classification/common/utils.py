@@ -1,69 +1,135 @@
 # -*- coding: utf-8 -*-
 import os
+import copy
+import shutil
+import hashlib
 import json
 import torch
 import random
+import time
+import queue
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from tqdm import tqdm
-from sklearn import metrics
 from azureml.pipeline.wrapper.dsl.module import OutputDirectory
 from azureml.core import Run
 
+from common.telemetry import TrainingTelemetry, log_rows_to_run
+from common.distributed import is_distributed, is_main_process, all_reduce_sum, unwrap_model
+from common.checkpoint import AsyncWriter, model_state, load_model
+from common.FastText import QuantizedFastText
+
 torch.manual_seed(1)
 np.random.seed(1)
 
 
+def build_optimizers(model, learning_rate):
+    """
+    Adam for the dense parameters, and SparseAdam for the parameters of the embeddings created with sparse=True,
+    since Adam doesn't accept sparse gradients.
+    """
+    sparse_params = [module.weight for module in model.modules()
+                     if isinstance(module, (torch.nn.Embedding, torch.nn.EmbeddingBag)) and module.sparse]
+    sparse_ids = {id(param) for param in sparse_params}
+    dense_params = [param for param in model.parameters() if id(param) not in sparse_ids]
+    optimizers = [torch.optim.Adam(dense_params, lr=learning_rate)]
+    if sparse_params:
+        optimizers.append(torch.optim.SparseAdam(sparse_params, lr=learning_rate))
+    return optimizers
+
+
 def train(model, trained_model_dir: OutputDirectory(type='AnyDirectory'), train_iter, dev_iter=None,
-          epochs=20, learning_rate=0.0001, stop_patience=3, device=None):
+          epochs=20, learning_rate=0.0001, stop_patience=3, device=None, checkpoint_manager=None):
+    """
+    BestModel is saved as a common.checkpoint.model_state in a background thread; use load_model to load it.
+    With a common.checkpoint.CheckpointManager, the training state is also saved after every epoch,
+    and the training resumes from the latest checkpoint of the manager if any.
+    If torch.distributed is initialized (see common.distributed.init_distributed), the model is trained
+    data-parallel: every process iterates over its own shard of the data, gradients are averaged by
+    DistributedDataParallel, validation metrics are summed over all the shards, so that every process takes the
+    same early stopping decision, and only rank 0 saves BestModel and logs metrics.
+    """
     if device is None:
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print('device:', device)
 
     model.train()
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
     model.to(device)
+    model_name = model._get_name()
+    if is_distributed():
+        model = torch.nn.parallel.DistributedDataParallel(model)
+    optimizers = build_optimizers(model, learning_rate)
     loss = torch.nn.CrossEntropyLoss()
 
     min_loss_epoch = (None, None)
-    stop_flag = False
+    start_epoch = 0
+    if checkpoint_manager is not None:
+        # every process loads the same checkpoint, so they stay in sync
+        last_epoch, state = checkpoint_manager.resume(unwrap_model(model), optimizers, map_location=device)
+        if last_epoch is not None:
+            start_epoch = last_epoch + 1
+            min_loss_epoch = tuple(state['min_loss_epoch'])
+            if state['stop']:
+                start_epoch = epochs
 
-    model_name = model._get_name()
     # for metrics
-    run = Run.get_context()
-    for epoch in range(epochs):
-        loss_value_list = []
+    main_process = is_main_process()
+    if start_epoch > 0 and main_process:
+        checkpoint_manager.copy_best(trained_model_dir)
+    writer = AsyncWriter()
+    telemetry = TrainingTelemetry(log_interval=50, sink=log_rows_to_run if main_process else lambda rows: None)
+    for epoch in range(start_epoch, epochs):
+        telemetry.start_epoch()
         total_iter = len(train_iter)
         for i, (btach_x, btach_y) in enumerate(train_iter):
             outputs = model(btach_x)
-            optimizer.zero_grad()
             loss_value = loss(outputs, btach_y)
+            for optimizer in optimizers:
+                optimizer.zero_grad()
             loss_value.backward()
-            optimizer.step()
-            loss_value_list.append(loss_value.cpu().data.numpy())
-            # for metrics
-            run.log(name='CrossEntropyLoss', value=np.mean(loss_value_list))
-            if i % 50 == 0:
-                str_ = f"{model_name} epoch:{epoch + 1}/{epochs} step:{i + 1}/{total_iter} mean_loss:{np.mean(loss_value_list): .4f}"
+            for optimizer in optimizers:
+                optimizer.step()
+            stats = telemetry.step(loss_value, len(btach_y))
+            if stats is not None and main_process:
+                str_ = f"{model_name} epoch:{epoch + 1}/{epochs} step:{i + 1}/{total_iter} mean_loss:{stats['loss']: .4f}" \
+                       f" {stats['steps_per_sec']:.1f} steps/s {stats['samples_per_sec']:.0f} samples/s"
                 print(str_)
 
-            if (i + 1) == total_iter and dev_iter is not None:
-                loss_, acc_, prec_, recall_, f1_ = evaluation(model, dev_iter)
+        # validate once the epoch is over, so that train_iter can also be a stream of unknown exact length
+        stop = False
+        if dev_iter is not None:
+            # the wrapped model, so that the forward passes don't wait for gradient synchronisation
+            loss_, acc_, prec_, recall_, f1_ = evaluation(unwrap_model(model), dev_iter)
+            if main_process:
                 str_ = f" validation loss:{loss_:.4f}  acc:{acc_:.4f}"
                 print(str_)
-                model.train()
+            model.train()
 
-                if (min_loss_epoch[0] is None) or (min_loss_epoch[0] > loss_):
-                    min_loss_epoch = (loss_, epoch)
+            # loss_ is the same on every process, which therefore all stop at the same epoch
+            if (min_loss_epoch[0] is None) or (min_loss_epoch[0] > loss_):
+                min_loss_epoch = (loss_, epoch)
+                if main_process:
                     os.makedirs(trained_model_dir, exist_ok=True)
                     path = os.path.join(trained_model_dir, "BestModel")
-                    torch.save(obj=model, f=path)
-                else:
-                    if (epoch - min_loss_epoch[1]) >= stop_patience:
-                        stop_flag = True
-                        break
-
-        if stop_flag is True:
+                    state = model_state(unwrap_model(model))
+                    writer.submit(state, path)
+                    if checkpoint_manager is not None:
+                        checkpoint_manager.save_best(state)
+            elif (epoch - min_loss_epoch[1]) >= stop_patience:
+                stop = True
+
+        if checkpoint_manager is not None and main_process:
+            checkpoint_manager.save(epoch, unwrap_model(model), optimizers, min_loss_epoch=min_loss_epoch, stop=stop)
+        if stop:
             break
+    # BestModel is complete once train() returns
+    writer.close()
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+    telemetry.close()
 
 
 def test(model, test_iter=None):
@@ -80,64 +146,286 @@ def test(model, test_iter=None):
     return acc_
 
 
+class StreamingMetrics(object):
+    """
+    Classification metrics accumulated over batches: a (num_classes, num_classes) confusion matrix of
+    (label, prediction) counts is updated on the device of the outputs with torch.bincount, and accuracy and the
+    macro precision, recall and F1 are computed once from it at the end, over the whole dataset.
+    As in sklearn, the macro averages are over the classes present in the labels or the predictions.
+    With num_classes, the counts are allocated on device upfront, so that a process without any batch can still
+    take part in all_reduce; otherwise num_classes and the device come from the first batch.
+    """
+    def __init__(self, num_classes=None, device=None):
+        self.num_classes = num_classes
+        self.confusion = None
+        self.loss_sum = None
+        self.num_samples = 0
+        if num_classes is not None:
+            self._allocate(device)
+
+    def _allocate(self, device):
+        self.confusion = torch.zeros((self.num_classes, self.num_classes), dtype=torch.long, device=device)
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+
+    def update(self, outputs, labels, loss=None):
+        """Add a batch of model outputs (logits), labels and optionally its mean loss."""
+        if self.confusion is None:
+            self.num_classes = outputs.shape[1]
+            self._allocate(outputs.device)
+        predictions = outputs.argmax(dim=1)
+        self.confusion += torch.bincount(labels * self.num_classes + predictions,
+                                         minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+        if loss is not None:
+            self.loss_sum += loss.detach().double() * len(labels)
+        self.num_samples += len(labels)
+
+    def all_reduce(self):
+        """
+        Sum the counts of all the processes with a single collective, so that every process gets global metrics.
+        Every process has to call it, including those without any batch, which needs num_classes at construction.
+        """
+        if self.confusion is None:
+            raise ValueError('StreamingMetrics needs num_classes to all_reduce before any batch')
+        packed = torch.cat([self.confusion.flatten().double(), self.loss_sum.view(1),
+                            torch.tensor([self.num_samples], dtype=torch.float64, device=self.confusion.device)])
+        all_reduce_sum(packed)
+        num_classes_2 = self.num_classes ** 2
+        self.confusion = packed[:num_classes_2].round().long().view(self.num_classes, self.num_classes)
+        self.loss_sum = packed[num_classes_2]
+        self.num_samples = int(packed[num_classes_2 + 1].item())
+
+    def compute(self):
+        """loss (mean over the samples), acc, precision, recall and f1 as python floats."""
+        if self.confusion is None or self.num_samples == 0:
+            return {'loss': float('nan'), 'acc': 0.0, 'precision': 0.0, 'recall': 0.0, 'f1': 0.0}
+        confusion = self.confusion.double().cpu()
+        true_positives = confusion.diag()
+        label_counts = confusion.sum(dim=1)
+        prediction_counts = confusion.sum(dim=0)
+        precision = true_positives / prediction_counts.clamp(min=1)
+        recall = true_positives / label_counts.clamp(min=1)
+        f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+        present = (label_counts + prediction_counts) > 0
+        return {
+            'loss': self.loss_sum.item() / max(self.num_samples, 1),
+            'acc': true_positives.sum().item() / max(self.num_samples, 1),
+            'precision': precision[present].mean().item(),
+            'recall': recall[present].mean().item(),
+            'f1': f1[present].mean().item(),
+        }
+
+
 def evaluation(model, data_iter):
+    """In data-parallel training, data_iter is the shard of the process and the metrics are over all the shards."""
     model.eval()
     with torch.no_grad():
-        acc_list = []
-        precision_list = []
-        recall_list = []
-        f1_list = []
-        loss_list = []
+        if is_distributed():
+            # allocated upfront: every process joins the all_reduce, even one whose shard has no batch
+            streaming_metrics = StreamingMetrics(num_classes=unwrap_model(model).fc2.out_features,
+                                                 device=next(model.parameters()).device)
+        else:
+            streaming_metrics = StreamingMetrics()
         loss = torch.nn.CrossEntropyLoss()
         for btach_x, btach_y in data_iter:
             outputs = model(btach_x)
-            p_ = torch.max(outputs.data, 1)[1].cpu().numpy()
-            y = btach_y.cpu()
-            acc_ = metrics.accuracy_score(y, p_)
-            precision_ = metrics.precision_score(y, p_, average='macro')
-            recall_ = metrics.recall_score(y, p_, average='macro')
-            f1_ = metrics.f1_score(y, p_, average='macro')
-            loss_ = loss(outputs, btach_y)
-            acc_list.append(acc_)
-            precision_list.append(precision_)
-            recall_list.append(recall_)
-            f1_list.append(f1_)
-            loss_list.append(loss_.cpu().data.numpy())
-
-        return np.mean(loss_list), np.mean(acc_list), np.mean(precision_list), np.mean(recall_list), np.mean(f1_list)
-
-
-def predict(model, data_iter, map_id_label):
+            streaming_metrics.update(outputs, btach_y, loss(outputs, btach_y))
+        if is_distributed():
+            streaming_metrics.all_reduce()
+        result = streaming_metrics.compute()
+        return result['loss'], result['acc'], result['precision'], result['recall'], result['f1']
+
+
+def predict(model, data_iter, map_id_label, metrics=None):
+    """
+    Predict the label of the last sample of data_iter.
+    The predictions are counted in metrics (a common.telemetry.InferenceMetrics) if given,
+    which flushes them in the background instead of logging every prediction to the run.
+    """
     model.eval()
-    # for metrics
-    run = Run.get_context()
     p_ = 0
     for batch_x, batch_y in data_iter:
         outputs = model(batch_x)
         p_ = torch.max(outputs.data, 1)[1].cpu()
-        run.log(name='Prediction Result', value=map_id_label[int(p_)])
+        if metrics is not None:
+            metrics.observe_predictions([map_id_label[int(p)] for p in p_])
     return map_id_label[int(p_)]
 
 
 def predict_parallel(model, data_iter, map_id_label):
     model.eval()
-    # for metrics
-    # run = Run.get_context()
     results = []
     for batch_x, batch_y in data_iter:
         outputs = model(batch_x)
         p_ = torch.max(outputs.data, 1)[1].cpu().numpy()
-        results.append(map_id_label[int(p_)])
-    # run.log(name='Prediction Result', value=results)
+        results.extend(map_id_label[int(p)] for p in p_)
     return results
 
 
+def predict_proba(model, data_iter):
+    """Predicted class id and its softmax probability of every sample, as two numpy arrays."""
+    model.eval()
+    classes = []
+    probabilities = []
+    with torch.no_grad():
+        for batch_x, batch_y in data_iter:
+            probability, class_ = torch.softmax(model(batch_x), dim=1).max(dim=1)
+            classes.append(class_.cpu().numpy())
+            probabilities.append(probability.cpu().numpy())
+    if not classes:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(classes), np.concatenate(probabilities)
+
+
+def _read_text(file):
+    with open(file, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+
+def score_files(model, files, word_to_index, map_id_label, max_len=32, ngram_size=200000, batch_size=1024,
+                num_workers=8, device=None):
+    """
+    Predict the class of the text of every file: the files are read with a thread pool and scored in
+    batches of batch_size. Returns the class label and probability of every file, None and nan for empty files.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        texts = list(executor.map(_read_text, files))
+    scored = [i for i, text in enumerate(texts) if len(text) > 0]
+    # 0 is the dummy label and doesn't work
+    ids, labels = lines_to_ids([texts[i] + '\t' + '0' for i in scored], word_to_index, {}, max_len, progress=False)
+    bigram, trigram = ngram_hashes(ids, ngram_size)
+    dataset = ArrayDataset(ids, bigram, trigram, labels)
+    class_ids, probabilities = predict_proba(model, DataIter(dataset, batch_size=batch_size, shuffle=False,
+                                                             device=device))
+    classes = [None] * len(files)
+    file_probabilities = np.full(len(files), np.nan, dtype=np.float32)
+    for i, class_id, probability in zip(scored, class_ids.tolist(), probabilities):
+        classes[i] = map_id_label[class_id]
+        file_probabilities[i] = probability
+    return classes, file_probabilities
+
+
 def get_vocab(path_word_to_index):
     with open(path_word_to_index, 'r', encoding='utf-8') as f:
         w2i = json.load(f)
     return w2i
 
 
+class CompactVocab(object):
+    """
+    word_to_index stored as two .npy arrays, the sorted words and their ids, which are memory-mapped at load time
+    instead of parsing word_to_index.json into a dict. Words are looked up by binary search.
+    The words are a fixed-width unicode array, 4 bytes per character of the longest word for every entry, so a
+    single long token can make vocab_words.npy much larger than word_to_index.json; it loads faster all the same.
+    """
+    WORDS_FILE = 'vocab_words.npy'
+    IDS_FILE = 'vocab_ids.npy'
+
+    def __init__(self, words, ids):
+        self.words = words
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    @classmethod
+    def save(cls, word_to_index, directory):
+        words = np.array(list(word_to_index.keys()))
+        ids = np.array(list(word_to_index.values()), dtype=np.int64)
+        order = np.argsort(words)
+        np.save(os.path.join(directory, cls.IDS_FILE), ids[order])
+        # written last, so that its presence means the vocab is complete.
+        np.save(os.path.join(directory, cls.WORDS_FILE), words[order])
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.isfile(os.path.join(directory, cls.WORDS_FILE))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return cls(np.load(os.path.join(directory, cls.WORDS_FILE), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, cls.IDS_FILE), mmap_mode=mmap_mode))
+
+    def lookup(self, words, default=1):
+        """Ids of a list of words as an int64 array, default ([UNK]) for unknown words."""
+        if len(words) == 0 or len(self.words) == 0:
+            return np.full(len(words), default, dtype=np.int64)
+        words = np.array(words, dtype=str)
+        # the search runs at the width of the vocab, which truncates the longer words: they are unknown anyway,
+        # the hits are compared with the whole words so that their truncation can't match a shorter word
+        positions = np.searchsorted(self.words, words.astype(self.words.dtype))
+        positions = np.minimum(positions, len(self.words) - 1)
+        return np.where(self.words[positions] == words, self.ids[positions], default).astype(np.int64)
+
+    def get(self, word, default=None):
+        position = np.searchsorted(self.words, word)
+        if position < len(self.words) and self.words[position] == word:
+            return int(self.ids[position])
+        return default
+
+
+def load_vocab(model_dir):
+    """The CompactVocab of a model directory if fasttext_train wrote one, otherwise word_to_index.json as a dict."""
+    if CompactVocab.exists(model_dir):
+        return CompactVocab.load(model_dir)
+    return get_vocab(os.path.join(model_dir, 'word_to_index.json'))
+
+
+def _lookup_ids(word_to_index, words):
+    if isinstance(word_to_index, CompactVocab):
+        return word_to_index.lookup(words)
+    return [word_to_index.get(word, 1) for word in words]
+
+
+TORCHSCRIPT_MODEL = 'BestModel.pt'
+
+
+def export_torchscript(model, path, max_len=32):
+    """Trace the model in eval mode on cpu and save it as TorchScript, which loads without the model classes."""
+    model = copy.deepcopy(model).cpu().eval()
+    example = torch.zeros((2, max_len), dtype=torch.long)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, ((example, example, example),))
+    traced.save(path)
+    return traced
+
+
+QUANTIZED_MODEL = 'BestModel.quantized.pt'
+
+
+def export_quantized(model, path, max_len=32):
+    """
+    Export the model as TorchScript with int8 embedding tables and int8 dynamically quantized Linear layers,
+    see common.FastText.QuantizedFastText. The quantized model only runs on cpu.
+    """
+    quantized = torch.quantization.quantize_dynamic(QuantizedFastText(model).eval(), {torch.nn.Linear},
+                                                    dtype=torch.qint8)
+    example = torch.zeros((2, max_len), dtype=torch.long)
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, ((example, example, example),))
+    traced.save(path)
+    return traced
+
+
+def load_scoring_model(model_dir, device=None, quantized=True):
+    """
+    The best export of a model directory: the quantized TorchScript model if fasttext_train exported one,
+    quantized is True and device is cpu, then the TorchScript model, otherwise BestModel.
+    """
+    path = os.path.join(model_dir, QUANTIZED_MODEL)
+    if quantized and os.path.isfile(path) and (device is None or torch.device(device).type == 'cpu'):
+        print(f'load quantized TorchScript model: {path}')
+        return torch.jit.load(path, map_location='cpu')
+    path = os.path.join(model_dir, TORCHSCRIPT_MODEL)
+    if os.path.isfile(path):
+        print(f'load TorchScript model: {path}')
+        return torch.jit.load(path, map_location=device)
+    return load_model(os.path.join(model_dir, 'BestModel'), map_location=device)
+
+
 def get_id_label(path_label):
     map_id_label = {}
     map_label_id = {}
@@ -160,10 +448,26 @@ def get_trigram_hash(sequence, index, ngram_size):
     return (word2 * 10600202 * 13800202 + word1 * 10600202) % ngram_size
 
 
-def load_dataset(file_path, word_to_index, map_label_id, max_len=32, ngram_size=200000):
-    # [PAD]:0    [UNK]:1
-    pad_id = word_to_index.get('[PAD]', 0)
-    samples = []
+def ngram_hashes(ids, ngram_size=200000):
+    """
+    Vectorised get_bigram_hash and get_trigram_hash over a padded (N, max_len) int64 id matrix.
+    The hash constants are reduced modulo ngram_size first, so that the products can't overflow int64
+    and the results are identical to the python integer arithmetic of the scalar functions.
+    """
+    ids = np.asarray(ids, dtype=np.int64) % ngram_size
+    # word1 is the previous id and word2 the one before, both 0 before the start of the sequence.
+    word1 = np.zeros_like(ids)
+    word1[:, 1:] = ids[:, :-1]
+    word2 = np.zeros_like(ids)
+    word2[:, 2:] = ids[:, :-2]
+    bigram_factor = 10600202 % ngram_size
+    trigram_factor = (10600202 * 13800202) % ngram_size
+    bigram = word1 * bigram_factor % ngram_size
+    trigram = (word2 * trigram_factor + bigram) % ngram_size
+    return bigram, trigram
+
+
+def _read_lines(file_path):
     # load dataset for batch inference
     if isinstance(file_path, list):
         lines = []
@@ -178,15 +482,175 @@ def load_dataset(file_path, word_to_index, map_label_id, max_len=32, ngram_size=
         with open(file_path, 'r', encoding='utf-8') as f:
             lines = f.read().split("\n")
             lines = [line.strip() for line in lines if len(line) > 0]
-    for line in tqdm(lines, desc="load data"):
+    return lines
+
+
+def lines_to_ids(lines, word_to_index, map_label_id, max_len=32, progress=True):
+    """Vocabulary lookup of the lines (text\tlabel), returns a padded (N, max_len) int64 id matrix and the labels."""
+    # [PAD]:0    [UNK]:1
+    pad_id = word_to_index.get('[PAD]', 0)
+    ids = np.full((len(lines), max_len), pad_id, dtype=np.int64)
+    labels = np.zeros(len(lines), dtype=np.int64)
+    for i, line in enumerate(tqdm(lines, desc="load data", disable=not progress)):
         line = line.split('\t')
-        text = line[0].split(' ')
-        label = line[1]
+        text = line[0].split(' ')[:max_len]
         # [UNK]:1
-        text = ([word_to_index.get(word, 1) for word in text]) + [pad_id] * (max_len - len(text))
-        text = text[:max_len]
-        samples.append(process_data(text, label, max_len, ngram_size, map_label_id))
-    return samples
+        ids[i, :len(text)] = [word_to_index.get(word, 1) for word in text]
+        # label not in map_label_id when inference
+        labels[i] = map_label_id.get(line[1], 0)
+    return ids, labels
+
+
+def load_dataset(file_path, word_to_index, map_label_id, max_len=32, ngram_size=200000):
+    dataset = load_dataset_arrays(file_path, word_to_index, map_label_id, max_len, ngram_size)
+    return list(zip(dataset.ids.tolist(), dataset.bigram.tolist(), dataset.trigram.tolist(), dataset.labels.tolist()))
+
+
+def load_dataset_arrays(file_path, word_to_index, map_label_id, max_len=32, ngram_size=200000):
+    """Same as load_dataset, but returns an ArrayDataset instead of a list of (text, bigram, trigram, id) tuples."""
+    lines = _read_lines(file_path)
+    ids, labels = lines_to_ids(lines, word_to_index, map_label_id, max_len)
+    bigram, trigram = ngram_hashes(ids, ngram_size)
+    return ArrayDataset(ids.astype(np.int32), bigram.astype(np.int32), trigram.astype(np.int32), labels)
+
+
+class ArrayDataset(object):
+    """
+    A preprocessed dataset stored as contiguous arrays: ids, bigram and trigram (N, max_len) int32, labels (N,) int64.
+    It can be saved as .npy files and memory-mapped back, and DataIter slices it directly.
+    """
+    FIELDS = ('ids', 'bigram', 'trigram', 'labels')
+    META_FILE = 'dataset.json'
+
+    def __init__(self, ids, bigram, trigram, labels):
+        self.ids = ids
+        self.bigram = bigram
+        self.trigram = trigram
+        self.labels = labels
+        self._lengths = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def lengths(self):
+        """Number of non-padding positions of every sample (padding id is 0, as in FastText)."""
+        if self._lengths is None:
+            self._lengths = (np.asarray(self.ids) != 0).sum(axis=1)
+        return self._lengths
+
+    def save(self, directory, **meta):
+        os.makedirs(directory, exist_ok=True)
+        for field in self.FIELDS:
+            np.save(os.path.join(directory, field + '.npy'), getattr(self, field))
+        # written last, so that its presence means the arrays are complete.
+        with open(os.path.join(directory, self.META_FILE), 'w', encoding='utf-8') as f:
+            json.dump({'num_samples': len(self), **meta}, f)
+
+    @classmethod
+    def exists(cls, directory, **meta):
+        """Whether directory holds a saved dataset whose meta (e.g. max_len, ngram_size) matches."""
+        path = os.path.join(directory, cls.META_FILE)
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'r', encoding='utf-8') as f:
+            saved_meta = json.load(f)
+        return all(saved_meta.get(key) == value for key, value in meta.items())
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(directory, field + '.npy'), mmap_mode=mmap_mode) for field in cls.FIELDS])
+
+
+def ngram_counts(data, ngram_size=200000, chunk_size=65536):
+    """
+    Number of occurrences of every bigram and trigram hash bucket in data, an ArrayDataset or an iterable of
+    (x, y) batches such as StreamingDataIter, as two (ngram_size,) int64 arrays. The padding positions are counted
+    too, since the model also looks them up.
+    """
+    counts = [np.zeros(ngram_size, dtype=np.int64), np.zeros(ngram_size, dtype=np.int64)]
+    if isinstance(data, ArrayDataset):
+        # in chunks, so that a memory-mapped dataset isn't loaded at once
+        chunks = ((data.bigram[start: start + chunk_size], data.trigram[start: start + chunk_size])
+                  for start in range(0, len(data), chunk_size))
+    else:
+        chunks = ((x[1].cpu().numpy(), x[2].cpu().numpy()) for x, _ in data)
+    for chunk in chunks:
+        for count, ids in zip(counts, chunk):
+            count += np.bincount(np.asarray(ids, dtype=np.int64).ravel(), minlength=ngram_size)
+    return counts
+
+
+def preprocess_dataset(data_dir, output_dir, word_to_index, map_label_id, max_len=32, ngram_size=200000):
+    """Preprocess data_dir/data.txt into output_dir as .npy files which load_data_dir memory-maps."""
+    dataset = load_dataset_arrays(os.path.join(data_dir, 'data.txt'), word_to_index, map_label_id,
+                                  max_len, ngram_size)
+    dataset.save(output_dir, max_len=max_len, ngram_size=ngram_size)
+    return dataset
+
+
+# Part of the dataset cache keys, to be bumped whenever the preprocessing changes what it outputs.
+DATASET_CACHE_VERSION = 1
+
+
+def dataset_cache_key(file_path, word_to_index, map_label_id, max_len=32, ngram_size=200000):
+    """
+    sha256 of everything the preprocessed arrays of file_path depend on: the content of the file, the vocab,
+    the labels, max_len and ngram_size. Hashing the file is a plain read, much cheaper than preprocessing it.
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    params = {'version': DATASET_CACHE_VERSION, 'max_len': max_len, 'ngram_size': ngram_size,
+              'labels': map_label_id, 'vocab': hashlib.sha256(json.dumps(
+                  word_to_index, ensure_ascii=False).encode('utf-8')).hexdigest()}
+    sha.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def load_cached_dataset(file_path, cache_dir, word_to_index, map_label_id, max_len=32, ngram_size=200000):
+    """
+    load_dataset_arrays through a cache of preprocessed datasets in cache_dir, one sub-directory per
+    dataset_cache_key: a hit memory-maps the arrays, a miss preprocesses file_path and saves them there.
+    The directory is written under a temporary name and renamed, so that concurrent writers, e.g. the processes
+    of a distributed training, never read a partial dataset.
+    """
+    start = time.time()
+    key = dataset_cache_key(file_path, word_to_index, map_label_id, max_len, ngram_size)
+    directory = os.path.join(cache_dir, key)
+    if ArrayDataset.exists(directory, max_len=max_len, ngram_size=ngram_size):
+        dataset = ArrayDataset.load(directory)
+        print(f'dataset cache hit: {file_path} -> {directory}, {len(dataset)} samples '
+              f'in {time.time() - start:.2f} sec')
+        return dataset
+    dataset = load_dataset_arrays(file_path, word_to_index, map_label_id, max_len, ngram_size)
+    tmp_directory = f'{directory}.tmp{os.getpid()}'
+    dataset.save(tmp_directory, max_len=max_len, ngram_size=ngram_size)
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # another process saved the same dataset first
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    print(f'dataset cache miss: {file_path} -> {directory}, {len(dataset)} samples '
+          f'preprocessed in {time.time() - start:.2f} sec')
+    return dataset
+
+
+def load_data_dir(data_dir, word_to_index, map_label_id, max_len=32, ngram_size=200000, cache_dir=None):
+    """
+    Load the dataset of a data directory as an ArrayDataset.
+    If preprocess_dataset was run on it with the same max_len and ngram_size, the arrays are memory-mapped,
+    otherwise data.txt is preprocessed, through the dataset cache of cache_dir if given (see load_cached_dataset).
+    """
+    if ArrayDataset.exists(data_dir, max_len=max_len, ngram_size=ngram_size):
+        print(f'memory-map preprocessed dataset: {data_dir}')
+        return ArrayDataset.load(data_dir)
+    file_path = os.path.join(data_dir, 'data.txt')
+    if cache_dir:
+        return load_cached_dataset(file_path, cache_dir, word_to_index, map_label_id, max_len, ngram_size)
+    return load_dataset_arrays(file_path, word_to_index, map_label_id, max_len, ngram_size)
 
 
 def load_dataset_for_realtime_inference(input_sentence, word_to_index, map_label_id, max_len=32, ngram_size=200000):
@@ -202,26 +666,51 @@ def load_dataset_for_realtime_inference(input_sentence, word_to_index, map_label
     return samples
 
 
+def load_sentences_for_realtime_inference(input_sentences, word_to_index, max_len=32, ngram_size=200000):
+    """Batched load_dataset_for_realtime_inference: an ArrayDataset with one sample per input sentence."""
+    import jieba
+    pad_id = word_to_index.get('[PAD]', 0)
+    ids = np.full((len(input_sentences), max_len), pad_id, dtype=np.int64)
+    sentences = [[word for word in jieba.lcut(input_sentence) if word != ' '][:max_len]
+                 for input_sentence in input_sentences]
+    # a single vocab lookup for all the words of the batch
+    word_ids = _lookup_ids(word_to_index, [word for words in sentences for word in words])
+    start = 0
+    for i, words in enumerate(sentences):
+        ids[i, :len(words)] = word_ids[start: start + len(words)]
+        start += len(words)
+    bigram, trigram = ngram_hashes(ids, ngram_size)
+    return ArrayDataset(ids, bigram, trigram, np.zeros(len(input_sentences), dtype=np.int64))
+
+
 def process_data(text: list, label: str, max_len=32, ngram_size=200000, map_label_id=None):
     bigram = []
     trigram = []
-    id_ = None
     for i in range(max_len):
         bigram.append(get_bigram_hash(text, i, ngram_size))
         trigram.append(get_trigram_hash(text, i, ngram_size))
-        # label not in map_label_id when inference
-        id_ = map_label_id[label] if label in map_label_id else 0
+    # label not in map_label_id when inference
+    id_ = map_label_id[label] if label in map_label_id else 0
     return (text, bigram, trigram, id_)
 
 
 class DataIter(object):
+    """
+    Iterate over (x, bigram, trigram), y batches of LongTensors.
+    samples is either a list of (text, bigram, trigram, id) tuples or an ArrayDataset,
+    which is sliced directly without any per-sample python conversion.
+    """
     def __init__(self, samples, batch_size=32, shuffle=True, device=None):
-        if shuffle:
+        self.order = None
+        if isinstance(samples, ArrayDataset):
+            if shuffle:
+                self.order = np.random.permutation(len(samples))
+        elif shuffle:
             random.shuffle(samples)
         self.samples = samples
         self.batch_size = batch_size
         self.batch_num = len(samples) // self.batch_size
-        self.residue = len(samples) % self.batch_num != 0
+        self.residue = len(samples) % self.batch_size != 0
         self.index = 0
         self.device = device
 
@@ -232,18 +721,33 @@ class DataIter(object):
         y = torch.LongTensor([sample[3] for sample in sub_samples]).to(self.device)
         return (x, bigram, trigram), y
 
+    def _array_to_tensor(self, start, end):
+        index = slice(start, end) if self.order is None else self.order[start:end]
+
+        def to_tensor(array):
+            # astype copies the (possibly memory-mapped, read-only) slice into a writable int64 array
+            return torch.from_numpy(array[index].astype(np.int64)).to(self.device)
+
+        return (to_tensor(self.samples.ids), to_tensor(self.samples.bigram), to_tensor(self.samples.trigram)), \
+            to_tensor(self.samples.labels)
+
+    def _batch(self, start, end):
+        if isinstance(self.samples, ArrayDataset):
+            return self._array_to_tensor(start, end)
+        return self._to_tensor(self.samples[start: end])
+
     def __next__(self):
         if self.index == self.batch_num and self.residue:
-            sub_samples = self.samples[self.index * self.batch_size: len(self.samples)]
+            start = self.index * self.batch_size
             self.index += 1
-            return self._to_tensor(sub_samples)
+            return self._batch(start, len(self.samples))
         elif self.index >= self.batch_num:
             self.index = 0
             raise StopIteration
         else:
-            sub_samples = self.samples[self.index * self.batch_size: (self.index + 1) * self.batch_size]
+            start = self.index * self.batch_size
             self.index += 1
-            return self._to_tensor(sub_samples)
+            return self._batch(start, start + self.batch_size)
 
     def __iter__(self):
         return self
@@ -253,3 +757,216 @@ class DataIter(object):
             return self.batch_num + 1
         else:
             return self.batch_num
+
+
+_worker_vocab = None
+
+
+def _init_preprocess_worker(word_to_index, map_label_id, max_len, ngram_size):
+    global _worker_vocab
+    _worker_vocab = (word_to_index, map_label_id, max_len, ngram_size)
+
+
+def _preprocess_lines(lines):
+    word_to_index, map_label_id, max_len, ngram_size = _worker_vocab
+    ids, labels = lines_to_ids(lines, word_to_index, map_label_id, max_len, progress=False)
+    bigram, trigram = ngram_hashes(ids, ngram_size)
+    return ids.astype(np.int32), bigram.astype(np.int32), trigram.astype(np.int32), labels
+
+
+class BucketDataIter(object):
+    """
+    Variable-length batching over an ArrayDataset: samples of similar length are batched together and every batch
+    is only padded to its longest sample instead of max_len.
+    The samples are shuffled, cut into pools of bucket_batches * batch_size samples, sorted by length within each
+    pool and batched, then the batches are shuffled, at every epoch.
+    Only meaningful with a FastText(pooling='masked_mean') model, whose output doesn't depend on padding.
+    """
+    def __init__(self, samples, batch_size=32, shuffle=True, device=None, bucket_batches=100):
+        self.samples = samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.bucket_batches = bucket_batches
+
+    def _batch_indices(self):
+        lengths = self.samples.lengths
+        order = np.random.permutation(len(lengths)) if self.shuffle else np.arange(len(lengths))
+        pool_size = self.bucket_batches * self.batch_size
+        batches = []
+        for start in range(0, len(order), pool_size):
+            pool = order[start: start + pool_size]
+            pool = pool[np.argsort(lengths[pool], kind='stable')]
+            batches.extend(pool[i: i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        if self.shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def _to_tensor(self, index):
+        length = max(int(self.samples.lengths[index].max()), 1)
+
+        def to_tensor(array):
+            return torch.from_numpy(array[index, :length].astype(np.int64)).to(self.device)
+
+        y = torch.from_numpy(self.samples.labels[index].astype(np.int64)).to(self.device)
+        return (to_tensor(self.samples.ids), to_tensor(self.samples.bigram), to_tensor(self.samples.trigram)), y
+
+    def __iter__(self):
+        for index in self._batch_indices():
+            yield self._to_tensor(index)
+
+    def __len__(self):
+        return (len(self.samples) + self.batch_size - 1) // self.batch_size
+
+
+class StreamingDataIter(object):
+    """
+    Constant-memory replacement of DataIter for a data.txt larger than RAM.
+    The file is read chunk_lines lines at a time, the vocabulary lookup and n-gram hashing of the chunks run in
+    num_workers processes (at most 2 * num_workers chunks in flight), and batches are drawn from a bounded
+    shuffle buffer of shuffle_buffer_size samples. Every iteration streams the file again.
+    """
+    def __init__(self, file_path, word_to_index, map_label_id, max_len=32, ngram_size=200000, batch_size=32,
+                 shuffle=True, shuffle_buffer_size=100000, chunk_lines=10000, num_workers=None, device=None):
+        self.file_path = file_path
+        self.preprocess_args = (word_to_index, map_label_id, max_len, ngram_size)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = max(shuffle_buffer_size, batch_size)
+        self.chunk_lines = chunk_lines
+        self.num_workers = num_workers or max(1, (os.cpu_count() or 1) - 1)
+        self.device = device
+        self._num_samples = None
+
+    def _read_chunks(self):
+        chunk = []
+        with open(self.file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) > 0:
+                    chunk.append(line)
+                    if len(chunk) == self.chunk_lines:
+                        yield chunk
+                        chunk = []
+        if chunk:
+            yield chunk
+
+    def _preprocessed_chunks(self):
+        with multiprocessing.Pool(self.num_workers, initializer=_init_preprocess_worker,
+                                  initargs=self.preprocess_args) as pool:
+            in_flight = deque()
+            for chunk in self._read_chunks():
+                in_flight.append(pool.apply_async(_preprocess_lines, (chunk,)))
+                if len(in_flight) >= 2 * self.num_workers:
+                    yield in_flight.popleft().get()
+            while in_flight:
+                yield in_flight.popleft().get()
+
+    def _to_tensor(self, arrays):
+        x, bigram, trigram, y = [torch.from_numpy(array.astype(np.int64)).to(self.device) for array in arrays]
+        return (x, bigram, trigram), y
+
+    def __iter__(self):
+        buffer = []
+        buffered = 0
+        for arrays in self._preprocessed_chunks():
+            buffer.append(arrays)
+            buffered += len(arrays[3])
+            if buffered < (self.shuffle_buffer_size if self.shuffle else self.batch_size):
+                continue
+            arrays = [np.concatenate(field) for field in zip(*buffer)]
+            if self.shuffle:
+                # emit a random half of the buffer and keep the other half to mix with the next chunks
+                arrays = self._permute(arrays, buffered)
+                emit = (buffered // 2 // self.batch_size) * self.batch_size or self.batch_size
+            else:
+                emit = (buffered // self.batch_size) * self.batch_size
+            for start in range(0, emit, self.batch_size):
+                yield self._to_tensor([field[start: start + self.batch_size] for field in arrays])
+            buffer = [[field[emit:] for field in arrays]]
+            buffered -= emit
+        if buffered:
+            arrays = [np.concatenate(field) for field in zip(*buffer)]
+            if self.shuffle:
+                arrays = self._permute(arrays, buffered)
+            for start in range(0, buffered, self.batch_size):
+                yield self._to_tensor([field[start: start + self.batch_size] for field in arrays])
+
+    @staticmethod
+    def _permute(arrays, n):
+        order = np.random.permutation(n)
+        return [field[order] for field in arrays]
+
+    def __len__(self):
+        # counting the non-empty lines is one extra streaming pass, done once
+        if self._num_samples is None:
+            with open(self.file_path, 'rb') as f:
+                self._num_samples = sum(1 for line in f if line.strip())
+        return (self._num_samples + self.batch_size - 1) // self.batch_size
+
+
+class PrefetchDataIter(object):
+    """
+    Wrap a DataIter or StreamingDataIter so that the next num_prefetch batches are assembled in a background thread
+    while the model runs the forward and backward pass of the current one.
+    Batches keep the (x, bigram, trigram), y contract and len() is the one of the wrapped iterator.
+    After each pass, the time the training loop spent waiting on data and computing is printed, and kept in
+    wait_time and compute_time.
+    """
+    _END = object()
+
+    def __init__(self, data_iter, num_prefetch=4):
+        self.data_iter = data_iter
+        self.num_prefetch = num_prefetch
+        self.wait_time = 0.0
+        self.compute_time = 0.0
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self.data_iter:
+                if not self._put(batches, batch, stop):
+                    return
+        except Exception as e:
+            self._put(batches, e, stop)
+            return
+        self._put(batches, self._END, stop)
+
+    @staticmethod
+    def _put(batches, item, stop):
+        # time out regularly, so that the thread ends if the consumer stops early
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        producer.start()
+        self.wait_time = 0.0
+        self.compute_time = 0.0
+        try:
+            while True:
+                start = time.time()
+                batch = batches.get()
+                returned = time.time()
+                self.wait_time += returned - start
+                if batch is self._END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+                self.compute_time += time.time() - returned
+        finally:
+            stop.set()
+            producer.join()
+        total = max(self.wait_time + self.compute_time, 1e-9)
+        print(f"data wait: {self.wait_time:.2f}s ({100 * self.wait_time / total:.1f}%)  "
+              f"compute: {self.compute_time:.2f}s ({100 * self.compute_time / total:.1f}%)")
+
+    def __len__(self):
+        return len(self.data_iter)
@@ -1,17 +1,18 @@
 import os
 import sys
 import json
-import shutil
 from pathlib import Path
 
 from azureml.core import Run
 from azureml.pipeline.wrapper.dsl.module import ModuleExecutor, InputDirectory, OutputDirectory
 from azureml.pipeline.wrapper import dsl
 
+from common.publish import publish_files
+
 
 @dsl.module(
     name="Compare Two Models",
-    version="0.0.18",
+    version="0.0.21",
     description="Choose the better model according to accuracy"
 )
 def compare_two_models(
@@ -38,19 +39,18 @@ def compare_two_models(
     if result_first >= second_first:
         print('choose the first model')
         run.log(name='which one', value='first')
-        src = os.path.join(first_trained_model, 'BestModel')
-        shutil.copy(src=src, dst=dst)
+        better_model = first_trained_model
     else:
         print('choose the second model')
         run.log(name='which one', value='second')
-        src = os.path.join(second_trained_model, 'BestModel')
-        shutil.copy(src=src, dst=dst)
-    path_word_to_index = os.path.join(first_trained_model, 'word_to_index.json')
-    path_label = os.path.join(first_trained_model, 'label.txt')
-    path_shared_params = os.path.join(first_trained_model, 'shared_params.json')
-    shutil.copy(src=path_word_to_index, dst=dst)
-    shutil.copy(src=path_label, dst=dst)
-    shutil.copy(src=path_shared_params, dst=dst)
+        better_model = second_trained_model
+    # the files are published as links rather than copies when possible
+    publish_files(better_model, dst, ['BestModel'])
+    # TorchScript and quantized exports, written by the recent versions of FastText Train
+    publish_files(better_model, dst, ['BestModel.pt', 'BestModel.quantized.pt'], optional=True)
+    publish_files(first_trained_model, dst, ['word_to_index.json', 'label.txt', 'shared_params.json'])
+    # prebuilt vocab, written by the recent versions of FastText Train
+    publish_files(first_trained_model, dst, ['vocab_words.npy', 'vocab_ids.npy'], optional=True)
     print('=====================================================')
 
 
@@ -3,25 +3,231 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+NGRAM_TABLES = ('embedding_bigram', 'embedding_trigram')
+
+
+def model_config(model):
+    """
+    Constructor arguments of a FastText or FastTextBag model, read from its layers,
+    so that it also works for models pickled before these arguments existed.
+    """
+    index = getattr(model, 'embedding_bigram_index', None)
+    if index is None:
+        ngram_size, ngram_rows = model.embedding_bigram.num_embeddings, None
+    else:
+        ngram_size = index.numel()
+        ngram_rows = (model.embedding_bigram.num_embeddings, model.embedding_trigram.num_embeddings)
+    return {'vocab_size': model.embedding.num_embeddings, 'class_num': model.fc2.out_features,
+            'dropout': model.dropout.p, 'embed_dim': model.embedding.embedding_dim,
+            'hidden_size': model.fc1.out_features, 'ngram_size': ngram_size,
+            'pooling': getattr(model, 'pooling', 'mean'), 'sparse_ngrams': model.embedding_bigram.sparse,
+            'ngram_rows': ngram_rows}
+
+
+def _register_ngram_indexes(model, ngram_size, ngram_rows):
+    """
+    The (ngram_size,) int32 tables mapping the hash buckets to the rows of a compacted bigram and trigram table,
+    as the buffers <table>_index, or None for full tables, which are indexed by the hash buckets directly.
+    """
+    for name in NGRAM_TABLES:
+        index = torch.zeros(ngram_size, dtype=torch.int32) if ngram_rows is not None else None
+        model.register_buffer(name + '_index', index)
+
+
+def _ngram_ids(model, name, ids):
+    # models pickled before the compaction was added have no index buffer
+    index = getattr(model, name + '_index', None)
+    return ids if index is None else index[ids].long()
+
+
+def zero_unused_ngrams(model, bigram_used, trigram_used):
+    """
+    Zero the rows of the hash buckets which the training data never hits, given (ngram_size,) bool masks of the
+    used ones, e.g. from common.utils.ngram_counts. Their gradients are always zero, so they stay exactly zero
+    during training with Adam and SparseAdam, and compact_ngrams drops them afterwards.
+    """
+    with torch.no_grad():
+        for name, used in zip(NGRAM_TABLES, (bigram_used, trigram_used)):
+            weight = getattr(model, name).weight
+            unused = ~torch.as_tensor(used, dtype=torch.bool, device=weight.device)
+            weight[unused] = 0
+
+
+def compact_ngrams(model):
+    """
+    A copy of a FastText or FastTextBag model whose bigram and trigram tables only keep their non-zero rows,
+    after a shared zero row 0 to which the zero rows are remapped through the <table>_index buffers.
+    Every hash bucket still looks up the same values, so the predictions are identical.
+    """
+    config = model_config(model)
+    state = model.state_dict()
+    rows = []
+    for name in NGRAM_TABLES:
+        weight = getattr(model, name).weight.detach()
+        used = torch.nonzero(weight.ne(0).any(dim=1)).flatten()
+        row_map = torch.zeros(weight.shape[0], dtype=torch.int32, device=weight.device)
+        row_map[used] = torch.arange(1, len(used) + 1, dtype=torch.int32, device=weight.device)
+        index = getattr(model, name + '_index', None)
+        # compacting a compacted model composes the two remappings
+        state[name + '_index'] = row_map if index is None else row_map[index.long()]
+        state[name + '.weight'] = torch.cat([weight.new_zeros((1, weight.shape[1])), weight[used]])
+        rows.append(len(used) + 1)
+    config['ngram_rows'] = tuple(rows)
+    compact = type(model)(**config).to(model.fc1.weight.device)
+    compact.load_state_dict(state)
+    return compact.train(model.training)
+
+
 class FastText(nn.Module):
-    def __init__(self, vocab_size, class_num, dropout=0.5, embed_dim=300, hidden_size=256, ngram_size=200000):
+    """
+    pooling='mean' averages the features over all max_len positions, padding included.
+    pooling='masked_mean' only averages over the non-padding positions (word id != 0), so that the output doesn't
+    depend on how much a sample is padded, which variable-length batches need.
+    sparse_ngrams=True makes the bigram and trigram tables produce sparse gradients, which only touch the rows
+    of the batch; they are then optimized with SparseAdam (see common.utils.build_optimizers).
+    ngram_rows=(bigram rows, trigram rows) builds compacted n-gram tables, see compact_ngrams.
+    """
+    def __init__(self, vocab_size, class_num, dropout=0.5, embed_dim=300, hidden_size=256, ngram_size=200000,
+                 pooling='mean', sparse_ngrams=False, ngram_rows=None):
         super(FastText, self).__init__()
+        if pooling not in ('mean', 'masked_mean'):
+            raise ValueError(f"pooling should be 'mean' or 'masked_mean', got {pooling}")
+        self.pooling = pooling
 
+        bigram_rows, trigram_rows = ngram_rows if ngram_rows is not None else (ngram_size, ngram_size)
         self.embedding = nn.Embedding(num_embeddings=vocab_size, embedding_dim=embed_dim, padding_idx=0)
-        self.embedding_bigram = nn.Embedding(num_embeddings=ngram_size, embedding_dim=embed_dim)
-        self.embedding_trigram = nn.Embedding(num_embeddings=ngram_size, embedding_dim=embed_dim)
+        self.embedding_bigram = nn.Embedding(num_embeddings=bigram_rows, embedding_dim=embed_dim, sparse=sparse_ngrams)
+        self.embedding_trigram = nn.Embedding(num_embeddings=trigram_rows, embedding_dim=embed_dim,
+                                              sparse=sparse_ngrams)
+        _register_ngram_indexes(self, ngram_size, ngram_rows)
         self.dropout = nn.Dropout(dropout)
         self.fc1 = nn.Linear(embed_dim * 3, hidden_size)
         self.fc2 = nn.Linear(hidden_size, class_num)
 
+    def config(self):
+        """The constructor arguments of this model, which rebuild it from a state_dict (see common.checkpoint)."""
+        return model_config(self)
+
     def forward(self, x):
         word_feature = self.embedding(x[0])
-        bigram_feature = self.embedding_bigram(x[1])
-        trigram_feature = self.embedding_trigram(x[2])
+        bigram_feature = self.embedding_bigram(_ngram_ids(self, 'embedding_bigram', x[1]))
+        trigram_feature = self.embedding_trigram(_ngram_ids(self, 'embedding_trigram', x[2]))
+        features = torch.cat((word_feature, bigram_feature, trigram_feature), -1)
+        # models pickled before pooling was added have no such attribute
+        if getattr(self, 'pooling', 'mean') == 'masked_mean':
+            mask = (x[0] != 0).unsqueeze(-1).to(features.dtype)
+            x = (features * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        else:
+            x = features.mean(dim=1)
+        x = self.dropout(x)
+        x = self.fc1(x)
+        x = F.relu(x)
+        x = self.fc2(x)
+        return x
+
+
+class FastTextBag(nn.Module):
+    """
+    FastText built on nn.EmbeddingBag: every feature is pooled inside its bag, so that the (B, L, 3 * embed_dim)
+    tensor of FastText is never materialised. Given the same weights, the outputs match FastText for both poolings.
+    The bags sum with per-sample weights, 1 / L (or mask / length for masked_mean) and 0 at the padding positions of
+    the word feature, which keeps the padding row at zero like padding_idx=0 does in FastText.
+    """
+    def __init__(self, vocab_size, class_num, dropout=0.5, embed_dim=300, hidden_size=256, ngram_size=200000,
+                 pooling='mean', sparse_ngrams=False, ngram_rows=None):
+        super(FastTextBag, self).__init__()
+        if pooling not in ('mean', 'masked_mean'):
+            raise ValueError(f"pooling should be 'mean' or 'masked_mean', got {pooling}")
+        self.pooling = pooling
+
+        bigram_rows, trigram_rows = ngram_rows if ngram_rows is not None else (ngram_size, ngram_size)
+        self.embedding = nn.EmbeddingBag(num_embeddings=vocab_size, embedding_dim=embed_dim, mode='sum')
+        self.embedding_bigram = nn.EmbeddingBag(num_embeddings=bigram_rows, embedding_dim=embed_dim, mode='sum',
+                                                sparse=sparse_ngrams)
+        self.embedding_trigram = nn.EmbeddingBag(num_embeddings=trigram_rows, embedding_dim=embed_dim, mode='sum',
+                                                 sparse=sparse_ngrams)
+        _register_ngram_indexes(self, ngram_size, ngram_rows)
+        with torch.no_grad():
+            self.embedding.weight[0].fill_(0)
+        self.dropout = nn.Dropout(dropout)
+        self.fc1 = nn.Linear(embed_dim * 3, hidden_size)
+        self.fc2 = nn.Linear(hidden_size, class_num)
+
+    def config(self):
+        """The constructor arguments of this model, which rebuild it from a state_dict (see common.checkpoint)."""
+        return model_config(self)
+
+    @classmethod
+    def from_fasttext(cls, model):
+        """Convert a trained FastText model, e.g. a BestModel checkpoint, keeping its weights."""
+        bag = cls(**model_config(model))
+        # the parameter names are the same, nn.EmbeddingBag also stores its table as weight
+        bag.load_state_dict(model.state_dict())
+        return bag.to(model.fc1.weight.device)
+
+    def forward(self, x):
+        mask = (x[0] != 0).to(self.fc1.weight.dtype)
+        if self.pooling == 'masked_mean':
+            ngram_weights = mask / mask.sum(dim=1, keepdim=True).clamp(min=1)
+            word_weights = ngram_weights
+        else:
+            ngram_weights = torch.full_like(mask, 1.0 / mask.shape[1])
+            word_weights = mask * ngram_weights
+        word_feature = self.embedding(x[0], per_sample_weights=word_weights)
+        bigram_feature = self.embedding_bigram(_ngram_ids(self, 'embedding_bigram', x[1]),
+                                               per_sample_weights=ngram_weights)
+        trigram_feature = self.embedding_trigram(_ngram_ids(self, 'embedding_trigram', x[2]),
+                                                 per_sample_weights=ngram_weights)
         x = torch.cat((word_feature, bigram_feature, trigram_feature), -1)
-        x = x.mean(dim=1)
         x = self.dropout(x)
         x = self.fc1(x)
         x = F.relu(x)
         x = self.fc2(x)
         return x
+
+
+def quantize_rows(weight):
+    """Symmetric int8 quantization of every row of an embedding table: (int8 table, fp32 scale per row)."""
+    scale = weight.abs().max(dim=1)[0].clamp(min=1e-12) / 127
+    return torch.round(weight / scale.unsqueeze(1)).to(torch.int8), scale
+
+
+class QuantizedFastText(nn.Module):
+    """
+    Inference-only copy of a trained FastText or FastTextBag, to be exported with TorchScript:
+    the three embedding tables are stored in int8 with a scale per row (4x smaller than fp32), and are
+    dequantized for the looked up rows only; fc1 and fc2 are meant to be dynamically quantized to int8
+    with torch.quantization.quantize_dynamic. The pooling and the n-gram index tables of a compacted model
+    are the same as the ones of the original model.
+    """
+    TABLES = ('embedding', 'embedding_bigram', 'embedding_trigram')
+
+    def __init__(self, model):
+        super(QuantizedFastText, self).__init__()
+        self.pooling = getattr(model, 'pooling', 'mean')
+        for name in self.TABLES:
+            table, scale = quantize_rows(getattr(model, name).weight.detach().float().cpu())
+            self.register_buffer(name + '_int8', table)
+            self.register_buffer(name + '_scale', scale)
+            index = getattr(model, name + '_index', None)
+            self.register_buffer(name + '_index', index.detach().cpu().clone() if index is not None else None)
+        self.fc1 = nn.Linear(model.fc1.in_features, model.fc1.out_features)
+        self.fc2 = nn.Linear(model.fc2.in_features, model.fc2.out_features)
+        self.fc1.load_state_dict(model.fc1.state_dict())
+        self.fc2.load_state_dict(model.fc2.state_dict())
+
+    def _lookup(self, name, ids):
+        ids = _ngram_ids(self, name, ids)
+        return getattr(self, name + '_int8')[ids].float() * getattr(self, name + '_scale')[ids].unsqueeze(-1)
+
+    def forward(self, x):
+        features = torch.cat([self._lookup(name, ids) for name, ids in zip(self.TABLES, x)], -1)
+        if self.pooling == 'masked_mean':
+            mask = (x[0] != 0).unsqueeze(-1).to(features.dtype)
+            x = (features * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        else:
+            x = features.mean(dim=1)
+        x = self.fc1(x)
+        x = F.relu(x)
+        x = self.fc2(x)
+        return x
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+from common.FastText import FastText, FastTextBag, model_config
+from common.publish import publish
+
+MODEL_CLASSES = {'FastText': FastText, 'FastTextBag': FastTextBag}
+CHECKPOINT_PATTERN = re.compile(r'^checkpoint-(\d+)\.pt$')
+
+
+def _to_cpu(obj):
+    """Copy of the tensors of a (nested) state on cpu, so that training can go on updating the originals."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def model_state(model):
+    """The model as {'model_class', 'model_config', 'state_dict'}, the format of BestModel."""
+    return {'model_class': model._get_name(), 'model_config': model_config(model),
+            'state_dict': _to_cpu(model.state_dict())}
+
+
+def build_model(state, map_location=None):
+    model = MODEL_CLASSES[state['model_class']](**state['model_config'])
+    model.load_state_dict(state['state_dict'])
+    return model.to(map_location) if map_location is not None else model
+
+
+def load_model(path, map_location=None):
+    """
+    Load a BestModel: either a model_state dict, or a whole pickled module as written by older trainings.
+    Either way the model is returned in eval mode.
+    """
+    obj = torch.load(f=path, map_location=map_location)
+    model = build_model(obj, map_location) if isinstance(obj, dict) and 'state_dict' in obj else obj
+    return model.eval()
+
+
+def rng_state():
+    """The python, numpy and torch random states, with numpy's as plain python values."""
+    numpy_state = np.random.get_state()
+    state = {'python': random.getstate(),
+             'numpy': (numpy_state[0], numpy_state[1].tolist()) + tuple(numpy_state[2:]),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    numpy_state = state['numpy']
+    np.random.set_state((numpy_state[0], np.array(numpy_state[1], dtype=np.uint32)) + tuple(numpy_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class AsyncWriter(object):
+    """
+    Save states with torch.save in a background thread, in submission order, so that training doesn't wait for
+    the disk. Files are written to a temporary path and renamed, so a reader never sees a partial file.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, state, path, on_saved=None):
+        """
+        Queue state to be saved to path, then on_saved(path) is called if given.
+        state must not be modified anymore by the caller, e.g. it is a _to_cpu copy.
+        """
+        self._raise_error()
+        self._queue.put((state, path, on_saved))
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, path, on_saved = item
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+                if on_saved is not None:
+                    on_saved(path)
+            except Exception as e:
+                self._error = e
+            self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def wait(self):
+        """Block until every submitted state is written, and raise the error of a failed write if any."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+
+class CheckpointManager(object):
+    """
+    Checkpoints of a training in directory, as checkpoint-<epoch>.pt: the model state, the optimizer states,
+    the epoch, the random states and any extra training state. They are written by an AsyncWriter,
+    and only the last keep_last of them are kept. resume() restores the latest one.
+    The best model so far is also kept in directory, so that a resumed training can still output it.
+    """
+    BEST_MODEL = 'BestModel'
+
+    def __init__(self, directory, keep_last=3):
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        self.writer = AsyncWriter()
+
+    def checkpoints(self):
+        """Paths of the checkpoints in directory, from the oldest to the latest."""
+        epochs = []
+        for name in os.listdir(self.directory):
+            match = CHECKPOINT_PATTERN.match(name)
+            if match:
+                epochs.append(int(match.group(1)))
+        return [os.path.join(self.directory, 'checkpoint-%04d.pt' % epoch) for epoch in sorted(epochs)]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def _prune(self, path):
+        if self.keep_last <= 0:
+            return
+        for old_path in self.checkpoints()[:-self.keep_last]:
+            os.remove(old_path)
+
+    def save(self, epoch, model, optimizers, **extra):
+        """Snapshot the training state after epoch on cpu, and write it in the background."""
+        state = {'epoch': epoch, 'model': model_state(model),
+                 'optimizers': [_to_cpu(optimizer.state_dict()) for optimizer in optimizers],
+                 'rng': rng_state(), 'extra': extra}
+        path = os.path.join(self.directory, 'checkpoint-%04d.pt' % epoch)
+        self.writer.submit(state, path, on_saved=self._prune)
+
+    def save_best(self, state):
+        """Write a model_state as the best model so far, in the background."""
+        self.writer.submit(state, os.path.join(self.directory, self.BEST_MODEL))
+
+    def copy_best(self, destination):
+        """Publish the best model saved by a previous run to the destination folder, if any."""
+        path = os.path.join(self.directory, self.BEST_MODEL)
+        if os.path.isfile(path):
+            os.makedirs(destination, exist_ok=True)
+            publish(path, destination)
+
+    def resume(self, model, optimizers, map_location=None):
+        """
+        Load the latest checkpoint into model and optimizers and restore the random states.
+        Returns (epoch of the checkpoint, extra training state), or (None, {}) if there is no checkpoint.
+        """
+        path = self.latest()
+        if path is None:
+            return None, {}
+        state = torch.load(f=path, map_location=map_location)
+        model.load_state_dict(state['model']['state_dict'])
+        for optimizer, optimizer_state in zip(optimizers, state['optimizers']):
+            optimizer.load_state_dict(optimizer_state)
+        set_rng_state(state['rng'])
+        print(f"resume after epoch {state['epoch'] + 1} from {path}")
+        return state['epoch'], state['extra']
+
+    def close(self):
+        self.writer.close()
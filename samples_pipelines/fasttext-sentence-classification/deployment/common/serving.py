@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import time
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class _Request(object):
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.start = time.time()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Aggregate concurrent realtime requests: the sentences of the requests arriving within max_wait_ms of the first one
+    (up to max_batch_size sentences) go through predict_fn in a single call, and each request gets its own results
+    back. predict_fn takes a list of sentences and returns one result per sentence.
+    The latencies of the last latency_window requests are kept to tune max_wait_ms and max_batch_size,
+    and are also recorded in metrics (a common.telemetry.InferenceMetrics) if given.
+    """
+    def __init__(self, predict_fn, max_batch_size=64, max_wait_ms=5, latency_window=10000, report_every=1000,
+                 metrics=None):
+        self.predict_fn = predict_fn
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.report_every = report_every
+        self.latencies = deque(maxlen=latency_window)
+        self.batch_sizes = deque(maxlen=latency_window)
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._num_requests = 0
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def predict(self, sentences):
+        """Predict a list of sentences, blocking until the batch containing them has run."""
+        sentences = list(sentences)
+        if not sentences:
+            # nothing to batch, and an empty batch can't be predicted
+            return []
+        request = _Request(sentences)
+        self._requests.put(request)
+        request.done.wait()
+        self._record(time.time() - request.start)
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        size = len(batch[0].sentences)
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.sentences)
+        return batch, size
+
+    def _loop(self):
+        while True:
+            batch, size = self._next_batch()
+            self.batch_sizes.append(size)
+            try:
+                results = self.predict_fn([sentence for request in batch for sentence in request.sentences])
+                start = 0
+                for request in batch:
+                    request.results = results[start: start + len(request.sentences)]
+                    start += len(request.sentences)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+    def _record(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self._num_requests += 1
+            report = self.report_every and self._num_requests % self.report_every == 0
+        if self.metrics is not None:
+            self.metrics.observe_latency(latency)
+        if report:
+            print(self.report())
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """Request latency percentiles in milliseconds over the latency window."""
+        latencies = np.array(self.latencies)
+        if len(latencies) == 0:
+            return {}
+        return {f'p{p}': float(v) * 1000 for p, v in zip(percentiles, np.percentile(latencies, percentiles))}
+
+    def report(self):
+        percentiles = ' '.join(f'{k}:{v:.1f}ms' for k, v in self.latency_percentiles().items())
+        batch_size = np.mean(self.batch_sizes) if self.batch_sizes else 0
+        return f'requests:{self._num_requests} latency {percentiles} mean batch size:{batch_size:.1f}'
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import time
+import atexit
+import bisect
+import threading
+from collections import Counter
+
+# Upper bounds of the histogram buckets, the last bucket counts everything above the last bound.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+class Histogram(object):
+    """Fixed-bucket histogram: observing a value is a bisect and an increment, whatever the number of values."""
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """Upper bound of the bucket containing the p-th percentile, max for the overflow bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(float(bound), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99)):
+        summary = {'count': self.count, 'mean': self.total / self.count if self.count else 0.0, 'max': self.max}
+        summary.update({f'p{p}': self.percentile(p) for p in percentiles})
+        return summary
+
+
+def log_to_run(snapshot):
+    """Default sink of InferenceMetrics: print the snapshot and log it to the current run."""
+    from azureml.core import Run
+    run = Run.get_context()
+    latency = snapshot['latency_ms']
+    batch_size = snapshot['batch_size']
+    print(f"inference metrics over {snapshot['interval']:.1f}s: predictions:{snapshot['predictions']} "
+          f"latency p50:{latency['p50']:.0f}ms p90:{latency['p90']:.0f}ms p99:{latency['p99']:.0f}ms "
+          f"mean batch size:{batch_size['mean']:.1f} classes:{snapshot['classes']}")
+    run.log(name='Predictions', value=snapshot['predictions'])
+    if snapshot['classes']:
+        run.log_row(name='Predicted Classes', **snapshot['classes'])
+    run.log_row(name='Latency (ms)', **{k: latency[k] for k in ('mean', 'p50', 'p90', 'p99', 'max')})
+    run.log(name='Mean Batch Size', value=batch_size['mean'])
+
+
+class BackgroundFlusher(object):
+    """Call flush() from a daemon thread every flush_interval seconds, and once more on close() or at exit."""
+    def __init__(self, flush_interval=60):
+        self.flush_interval = flush_interval
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._loop, daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def flush(self):
+        raise NotImplementedError
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        if not self._stop.is_set():
+            self._stop.set()
+            self.flush()
+
+
+class InferenceMetrics(BackgroundFlusher):
+    """
+    In-process inference metrics: predicted class counts, a latency histogram and a batch size histogram.
+    Recording only takes a lock and updates counters, so it is safe to call on the request path;
+    a daemon thread hands a snapshot of the metrics to sink every flush_interval seconds, and once more at exit.
+    """
+    def __init__(self, flush_interval=60, sink=log_to_run):
+        self.sink = sink
+        self._lock = threading.Lock()
+        self._reset()
+        super(InferenceMetrics, self).__init__(flush_interval)
+
+    def _reset(self):
+        self._classes = Counter()
+        self._latency = Histogram(LATENCY_BUCKETS_MS)
+        self._batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self._start = time.time()
+
+    def observe_predictions(self, classes):
+        """Count the predicted classes of one batch, the batch size being the number of classes."""
+        with self._lock:
+            self._classes.update(classes)
+            self._batch_size.observe(len(classes))
+
+    def observe_latency(self, seconds):
+        with self._lock:
+            self._latency.observe(seconds * 1000)
+
+    def snapshot(self, reset=True):
+        with self._lock:
+            snapshot = {
+                'interval': time.time() - self._start,
+                'predictions': sum(self._classes.values()),
+                'classes': {str(label): count for label, count in self._classes.items()},
+                'latency_ms': self._latency.summary(),
+                'batch_size': self._batch_size.summary(),
+            }
+            if reset:
+                self._reset()
+        return snapshot
+
+    def flush(self):
+        snapshot = self.snapshot()
+        if snapshot['predictions'] or snapshot['latency_ms']['count']:
+            try:
+                self.sink(snapshot)
+            except Exception as e:
+                # metrics must never break inference
+                print(f'failed to flush inference metrics: {e}')
+
+
+def log_rows_to_run(rows):
+    """Default sink of TrainingTelemetry: log the loss series and the throughput of each row to the current run."""
+    from azureml.core import Run
+    run = Run.get_context()
+    for row in rows:
+        run.log(name='CrossEntropyLoss', value=row['loss'])
+        run.log_row(name='Training Throughput', step=row['step'], steps_per_sec=row['steps_per_sec'],
+                    samples_per_sec=row['samples_per_sec'])
+
+
+class TrainingTelemetry(BackgroundFlusher):
+    """
+    Training loss and throughput. The loss of every step is added to a running sum on its device, so step() doesn't
+    force a device sync; the mean loss of the epoch is only read every log_interval steps, together with the
+    steps/sec and samples/sec since the previous read. These rows are queued and handed to sink in batches by a
+    daemon thread every flush_interval seconds, instead of one remote metric call per step.
+    """
+    def __init__(self, log_interval=50, flush_interval=30, sink=log_rows_to_run):
+        self.log_interval = log_interval
+        self.sink = sink
+        self.total_steps = 0
+        self._lock = threading.Lock()
+        self._rows = []
+        self.start_epoch()
+        super(TrainingTelemetry, self).__init__(flush_interval)
+
+    def start_epoch(self):
+        self._loss_sum = 0
+        self._epoch_steps = 0
+        self._interval_steps = 0
+        self._interval_samples = 0
+        self._interval_start = time.time()
+
+    def step(self, loss, num_samples):
+        """
+        Record the mean loss (a tensor) of one training step over num_samples samples.
+        Returns the stats of the epoch so far on the first step and then every log_interval steps, None otherwise.
+        """
+        self._loss_sum = self._loss_sum + loss.detach()
+        self._epoch_steps += 1
+        self._interval_steps += 1
+        self._interval_samples += num_samples
+        self.total_steps += 1
+        if (self._epoch_steps - 1) % self.log_interval == 0:
+            return self.log()
+        return None
+
+    def log(self):
+        """Read the mean loss of the epoch and the throughput since the previous log, and queue them as a row."""
+        now = time.time()
+        elapsed = max(now - self._interval_start, 1e-6)
+        row = {
+            'step': self.total_steps,
+            'loss': float(self._loss_sum) / max(self._epoch_steps, 1),
+            'steps_per_sec': self._interval_steps / elapsed,
+            'samples_per_sec': self._interval_samples / elapsed,
+        }
+        self._interval_steps = 0
+        self._interval_samples = 0
+        self._interval_start = now
+        with self._lock:
+            self._rows.append(row)
+        return row
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if rows:
+            try:
+                self.sink(rows)
+            except Exception as e:
+                print(f'failed to flush training metrics: {e}')
@@ -1,14 +1,19 @@
 import os
 import json
+import time
 
 import torch
 from inference_schema.schema_decorators import input_schema, output_schema
 from inference_schema.parameter_types.standard_py_parameter_type import StandardPythonParameterType
 
-from common.utils import load_dataset_for_realtime_inference, DataIter, predict, get_vocab, get_id_label
+from common.utils import load_sentences_for_realtime_inference, DataIter, predict_proba, load_vocab, get_id_label, \
+    load_scoring_model
+from common.serving import MicroBatcher
+from common.telemetry import InferenceMetrics
 
 def init():
-    global model, word_to_index, map_label_id, map_id_label, device, shared_params
+    global model, word_to_index, map_label_id, map_id_label, device, shared_params, batcher, metrics, first_request
+    start = time.time()
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print('device:', device)
     model_dir = os.getenv('AZUREML_MODEL_DIR')
@@ -18,32 +23,78 @@ def init():
     path = os.path.join(model_dir, 'shared_params.json')
     with open(path, 'r', encoding='utf-8') as f:
         shared_params = json.load(f)
-    path_word_to_index = os.path.join(model_dir, 'word_to_index.json')
-    word_to_index = get_vocab(path_word_to_index)
+    # memory-mapped prebuilt vocab and quantized TorchScript model when the model was trained by a recent
+    # FastText Train, word_to_index.json and BestModel otherwise. FASTTEXT_USE_QUANTIZED=0 loads full precision.
+    word_to_index = load_vocab(model_dir)
     path_label = os.path.join(model_dir, 'label.txt')
     map_id_label, map_label_id = get_id_label(path_label)
-    model_name = 'BestModel'
-    model_path = os.path.join(model_dir, model_name)
-    model = torch.load(f=model_path, map_location=device)
+    model = load_scoring_model(model_dir, device, quantized=os.getenv('FASTTEXT_USE_QUANTIZED', '1') != '0')
+    # prediction counts, latencies and batch sizes are flushed every FASTTEXT_METRICS_INTERVAL seconds
+    metrics = InferenceMetrics(flush_interval=float(os.getenv('FASTTEXT_METRICS_INTERVAL', 60)))
+    # concurrent requests arriving within FASTTEXT_MAX_WAIT_MS are run as one batch
+    batcher = MicroBatcher(predict_sentences, max_batch_size=int(os.getenv('FASTTEXT_MAX_BATCH_SIZE', 64)),
+                           max_wait_ms=float(os.getenv('FASTTEXT_MAX_WAIT_MS', 5)), metrics=metrics)
+    load_end = time.time()
+    warm_up()
+    end = time.time()
+    first_request = True
+    print('cold start: %.3f sec (loading %.3f sec, warm-up %.3f sec)' % (end - start, load_end - start,
+                                                                         end - load_end))
+
+
+def warm_up():
+    """Load the jieba dictionary and run the model once at the batch sizes served, before the first request."""
+    import jieba
+    jieba.initialize()
+    for batch_size in {1, batcher.max_batch_size}:
+        samples = load_sentences_for_realtime_inference([standard_sample_input['input_sentence']] * batch_size,
+                                                        word_to_index=word_to_index,
+                                                        max_len=shared_params['max_len'],
+                                                        ngram_size=shared_params['ngram_size'])
+        predict_proba(model, DataIter(samples=samples, batch_size=batch_size, shuffle=False, device=device))
+
+def predict_sentences(sentences):
+    with torch.no_grad():
+        samples = load_sentences_for_realtime_inference(sentences, word_to_index=word_to_index,
+                                                        max_len=shared_params['max_len'],
+                                                        ngram_size=shared_params['ngram_size'])
+        data_iter = DataIter(samples=samples, batch_size=len(sentences), shuffle=False, device=device)
+        class_ids, _ = predict_proba(model, data_iter)
+    results = [map_id_label[class_id] for class_id in class_ids.tolist()]
+    metrics.observe_predictions(results)
+    return results
 
 
 standard_sample_input = {'input_sentence': 'i want to travel around the world'}
 standard_sample_output = {'category': 'dream'}
+# the batched form of the request, which run() also accepts: the categories of the sentences, in order
+batch_sample_input = {'input_sentences': ['i want to travel around the world']}
+batch_sample_output = ['dream']
 
 
 @input_schema('param', StandardPythonParameterType(standard_sample_input))
 @output_schema(StandardPythonParameterType(standard_sample_output))
 def run(param):
-    with torch.no_grad():
-        test_samples = load_dataset_for_realtime_inference(input_sentence=param['input_sentence'],
-                                                           word_to_index=word_to_index, map_label_id=map_label_id,
-                                                           max_len=shared_params['max_len'],
-                                                           ngram_size=shared_params['ngram_size'])
-        test_iter = DataIter(samples=test_samples, batch_size=1, shuffle=False, device=device)
-        try:
-            result = predict(model, test_iter, map_id_label)
-            # You can return any data type, as long as it is JSON serializable.
-            return result
-        except Exception as e:
-            error = str(e)
-            return error
+    # Either one sentence in input_sentence, which returns its category,
+    # or a list of sentences in input_sentences, which returns the list of their categories.
+    global first_request
+    start = time.time()
+    try:
+        if 'input_sentences' in param:
+            sentences = param['input_sentences']
+            # a string would otherwise be classified one character at a time
+            if not isinstance(sentences, list):
+                raise ValueError('input_sentences should be a list of strings, got a %s' % type(sentences).__name__)
+            if not all(isinstance(sentence, str) for sentence in sentences):
+                raise ValueError('input_sentences should only contain strings')
+            # MicroBatcher.predict returns [] for an empty list
+            return batcher.predict(sentences)
+        # You can return any data type, as long as it is JSON serializable.
+        return batcher.predict([param['input_sentence']])[0]
+    except Exception as e:
+        error = str(e)
+        return error
+    finally:
+        if first_request:
+            first_request = False
+            print('first request latency: %.1f ms' % ((time.time() - start) * 1000))
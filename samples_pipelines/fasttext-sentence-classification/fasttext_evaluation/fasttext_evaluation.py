@@ -7,19 +7,20 @@ import torch
 from azureml.pipeline.wrapper.dsl.module import ModuleExecutor, InputDirectory, OutputDirectory
 from azureml.pipeline.wrapper import dsl
 
-from common.utils import load_dataset, DataIter, test, get_vocab, get_id_label
+from common.utils import load_data_dir, DataIter, test, get_vocab, get_id_label, load_model
 
 
 @dsl.module(
     name="FastText Evaluation",
-    version='0.0.8',
+    version='0.0.10',
     description='Evaluate the trained fastText model',
     base_image='mcr.microsoft.com/azureml/intelmpi2018.3-cuda10.0-cudnn7-ubuntu16.04'
 )
 def fasttext_evaluation(
         model_testing_result: OutputDirectory(),
         trained_model_dir: InputDirectory() = None,
-        test_data_dir: InputDirectory() = None
+        test_data_dir: InputDirectory() = None,
+        cache_dir=''
 ):
     print('=====================================================')
     print(f'trained_model_dir: {Path(trained_model_dir).resolve()}')
@@ -33,13 +34,12 @@ def fasttext_evaluation(
     path = os.path.join(trained_model_dir, 'shared_params.json')
     with open(path, 'r', encoding='utf-8') as f:
         shared_params = json.load(f)
-    path = os.path.join(test_data_dir, 'data.txt')
-    test_samples = load_dataset(file_path=path, max_len=shared_params['max_len'],
-                                ngram_size=shared_params['ngram_size'], word_to_index=word_to_index,
-                                map_label_id=map_label_id)
+    test_samples = load_data_dir(data_dir=test_data_dir, max_len=shared_params['max_len'],
+                                 ngram_size=shared_params['ngram_size'], word_to_index=word_to_index,
+                                 map_label_id=map_label_id, cache_dir=cache_dir)
     test_iter = DataIter(samples=test_samples, shuffle=False, device=device)
     path = os.path.join(trained_model_dir, 'BestModel')
-    model = torch.load(f=path, map_location=device)
+    model = load_model(path, map_location=device)
     path = os.path.join(model_testing_result, 'result.json')
     acc_ = test(model, test_iter)
     with open(path, 'w', encoding='utf-8') as f:
@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import time
 import pandas as pd
 from uuid import uuid4
 
@@ -9,12 +10,13 @@ from pathlib import Path
 from azureml.pipeline.wrapper.dsl.module import ModuleExecutor, InputDirectory, OutputDirectory
 from azureml.pipeline.wrapper import dsl
 
-from common.utils import DataIter, load_dataset, predict_parallel, get_vocab, get_id_label
+from common.utils import score_files, get_vocab, get_id_label, load_scoring_model
+from common.telemetry import InferenceMetrics
 
 
 @dsl.module(
     name="FastText Score",
-    version='0.0.23',
+    version='0.0.27',
     description='Predict the categories of the input sentences',
     job_type='parallel',
     parallel_inputs=[InputDirectory(name='Texts to score')],
@@ -22,7 +24,11 @@ from common.utils import DataIter, load_dataset, predict_parallel, get_vocab, ge
 )
 def fasttext_score(
         scored_data_output_dir: OutputDirectory(),
-        fasttext_model_dir: InputDirectory() = '.'
+        fasttext_model_dir: InputDirectory() = '.',
+        scoring_batch_size=1024,
+        num_io_workers=8,
+        metrics_flush_interval=60,
+        use_quantized_model=True
 ):
     print('=====================================================')
     print(f'fasttext_model: {Path(fasttext_model_dir).resolve()}')
@@ -36,22 +42,22 @@ def fasttext_score(
     path = os.path.join(fasttext_model_dir, 'shared_params.json')
     with open(path, 'r', encoding='utf-8') as f:
         shared_params = json.load(f)
-    path = os.path.join(fasttext_model_dir, 'BestModel')
-    model = torch.load(f=path, map_location=device)
+    model = load_scoring_model(fasttext_model_dir, device, quantized=use_quantized_model)
+    metrics = InferenceMetrics(flush_interval=metrics_flush_interval)
 
     def run(files):
         if len(files) == 0:
             return []
-        with torch.no_grad():
-            test_samples = load_dataset(file_path=files, max_len=shared_params['max_len'],
-                                        ngram_size=shared_params['ngram_size'], word_to_index=word_to_index,
-                                        map_label_id=map_label_id)
-            test_iter = DataIter(samples=test_samples, batch_size=1, shuffle=False, device=device)
-            results = predict_parallel(model, test_iter, map_id_label)
-            dict_ = {'Filename': files, 'Class': results}
-            df = pd.DataFrame(data=dict_)
-            output_file = os.path.join(scored_data_output_dir, f"{uuid4().hex}.parquet")
-            df.to_parquet(output_file, index=False)
+        start = time.time()
+        results, probabilities = score_files(model, files, word_to_index=word_to_index, map_id_label=map_id_label,
+                                             max_len=shared_params['max_len'], ngram_size=shared_params['ngram_size'],
+                                             batch_size=scoring_batch_size, num_workers=num_io_workers, device=device)
+        metrics.observe_latency(time.time() - start)
+        metrics.observe_predictions([result for result in results if result is not None])
+        dict_ = {'Filename': files, 'Class': results, 'Probability': probabilities}
+        df = pd.DataFrame(data=dict_)
+        output_file = os.path.join(scored_data_output_dir, f"{uuid4().hex}.parquet")
+        df.to_parquet(output_file, index=False)
         return results
 
     return run
@@ -3,19 +3,25 @@ import sys
 import json
 import time
 import torch
-import shutil
 
 from azureml.pipeline.wrapper import dsl
 from azureml.pipeline.wrapper.dsl.module import ModuleExecutor, InputDirectory, OutputDirectory
 
-from common.FastText import FastText
-from common.utils import get_vocab, get_id_label, load_dataset, DataIter, train
+from common.FastText import FastText, FastTextBag, zero_unused_ngrams, compact_ngrams
+from common.checkpoint import CheckpointManager, model_state
+from common.publish import publish_files
+from common.distributed import init_distributed, get_local_world_size, shard_dataset, barrier, all_reduce_sum
+from common.utils import get_vocab, get_id_label, load_data_dir, DataIter, StreamingDataIter, \
+    BucketDataIter, PrefetchDataIter, CompactVocab, export_torchscript, export_quantized, train, load_model, \
+    ngram_counts, TORCHSCRIPT_MODEL, QUANTIZED_MODEL
 
 
 @dsl.module(
     name="FastText Train",
-    version='0.0.41',
-    description='Train the fastText model.',
+    version='0.0.56',
+    description='Train the fastText model. Runs as an MPI job: one process trains alone, '
+                'several processes (process_count_per_node/node_count) train data-parallel.',
+    job_type='mpi',
     base_image='mcr.microsoft.com/azureml/intelmpi2018.3-cuda10.0-cudnn7-ubuntu16.04'
 )
 def fasttext_train(
@@ -29,8 +35,19 @@ def fasttext_train(
         hidden_size=256,
         ngram_size=200000,
         dropout=0.5,
-        learning_rate=0.001
-
+        learning_rate=0.001,
+        streaming=False,
+        shuffle_buffer_size=100000,
+        prefetch_batches=4,
+        variable_length=False,
+        embedding_bag=False,
+        num_threads=0,
+        num_interop_threads=0,
+        sparse_ngrams=False,
+        checkpoint_dir='',
+        keep_checkpoints=3,
+        prune_ngrams=False,
+        cache_dir=''
 ):
     print('============================================')
     print('training_data_dir:', training_data_dir)
@@ -44,34 +61,108 @@ def fasttext_train(
     stop_patience = 5
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print('device:', device)
+    # With several processes (e.g. an MPI job with several processes per node), train data-parallel with gloo.
+    rank, world_size = init_distributed(backend='gloo')
+    if world_size > 1 and streaming:
+        raise ValueError('streaming is not supported in distributed training, preprocess the dataset instead')
+    if world_size > 1 and not sparse_ngrams:
+        print(f'WARNING: without sparse_ngrams, every step all-reduces the full {ngram_size}-row n-gram tables '
+              f'across the {world_size} processes, set sparse_ngrams to only exchange the rows of the batch')
+    # 0 keeps the torch defaults, usually one intra-op thread per physical core,
+    # which are shared by the processes of the node in distributed training.
+    # set_num_interop_threads only works before any inter-op parallel work, so this is done first.
+    if num_interop_threads > 0:
+        torch.set_num_interop_threads(num_interop_threads)
+    if num_threads == 0 and get_local_world_size() > 1:
+        num_threads = max(1, (os.cpu_count() or 1) // get_local_world_size())
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    print(f'intra-op threads: {torch.get_num_threads()} inter-op threads: {torch.get_num_interop_threads()}')
+    if streaming:
+        # stream data.txt in chunks instead of loading it, for corpora larger than memory
+        def load_iter(data_dir, shuffle, drop_last=True):
+            return StreamingDataIter(file_path=os.path.join(data_dir, 'data.txt'), word_to_index=word_to_index,
+                                     map_label_id=map_label_id, max_len=max_len, ngram_size=ngram_size,
+                                     batch_size=batch_size, shuffle=shuffle,
+                                     shuffle_buffer_size=shuffle_buffer_size, device=device)
+    else:
+        def load_iter(data_dir, shuffle, drop_last=True):
+            # with a cache_dir, reruns on the same data.txt and vocab skip the preprocessing
+            samples = load_data_dir(data_dir=data_dir, word_to_index=word_to_index, map_label_id=map_label_id,
+                                    max_len=max_len, ngram_size=ngram_size, cache_dir=cache_dir)
+            if world_size > 1:
+                # every process trains on its own interleaved shard
+                samples = shard_dataset(samples, rank, world_size, drop_last=drop_last)
+            if variable_length:
+                # batch samples of similar length, padded to the longest one of each batch
+                return BucketDataIter(samples=samples, batch_size=batch_size, shuffle=shuffle, device=device)
+            return DataIter(samples=samples, batch_size=batch_size, shuffle=shuffle, device=device)
+
     # load training dataset
-    path = os.path.join(training_data_dir, 'data.txt')
-    train_samples = load_dataset(file_path=path, word_to_index=word_to_index, map_label_id=map_label_id,
-                                 max_len=max_len, ngram_size=ngram_size)
-    train_iter = DataIter(samples=train_samples, batch_size=batch_size, shuffle=True, device=device)
+    train_iter = load_iter(training_data_dir, shuffle=True)
+    if prune_ngrams:
+        # count the n-gram hash buckets which the training data hits, summed over the shards,
+        # streaming costs one extra pass over data.txt
+        stats_data = load_iter(training_data_dir, shuffle=False) if streaming else train_iter.samples
+        bigram_counts, trigram_counts = [all_reduce_sum(torch.from_numpy(counts)).numpy()
+                                         for counts in ngram_counts(stats_data, ngram_size=ngram_size)]
+    if prefetch_batches > 0:
+        # assemble the next batches in the background while the model computes
+        train_iter = PrefetchDataIter(train_iter, num_prefetch=prefetch_batches)
     # load validation dataset
-    path = os.path.join(validation_data_dir, 'data.txt')
-    dev_samples = load_dataset(file_path=path, word_to_index=word_to_index, map_label_id=map_label_id,
-                               max_len=max_len, ngram_size=ngram_size)
-    dev_iter = DataIter(samples=dev_samples, batch_size=batch_size, shuffle=True, device=device)
+    # the validation metrics are summed over the shards, so none of its samples is dropped
+    dev_iter = load_iter(validation_data_dir, shuffle=True, drop_last=False)
 
-    model = FastText(vocab_size=vocab_size, class_num=class_num, dropout=dropout, embed_dim=embed_dim,
-                     hidden_size=hidden_size, ngram_size=ngram_size)
+    model_class = FastTextBag if embedding_bag else FastText
+    model = model_class(vocab_size=vocab_size, class_num=class_num, dropout=dropout, embed_dim=embed_dim,
+                        hidden_size=hidden_size, ngram_size=ngram_size,
+                        pooling='masked_mean' if variable_length else 'mean', sparse_ngrams=sparse_ngrams)
+    if prune_ngrams:
+        # the unused rows stay zero during training, and are dropped from BestModel afterwards
+        zero_unused_ngrams(model, bigram_counts > 0, trigram_counts > 0)
+        print(f'used n-gram buckets: bigram {(bigram_counts > 0).sum()}/{ngram_size} '
+              f'trigram {(trigram_counts > 0).sum()}/{ngram_size}')
     # watch parameters
     print(model.parameters)
-    # copy word_to_index.json and label.txt for later scoring.
-    shutil.copy(src=path_word_to_index, dst=trained_model_dir)
-    shutil.copy(src=path_label, dst=trained_model_dir)
-    # shared parameters for loading dataset
-    shared_params = {'max_len': max_len, 'ngram_size': ngram_size}
-    path = os.path.join(trained_model_dir, 'shared_params.json')
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(shared_params, f)
+    # only rank 0 writes to trained_model_dir
+    if rank == 0:
+        # publish word_to_index.json and label.txt for later scoring, as links rather than copies when possible
+        publish_files(training_data_dir, trained_model_dir, ['word_to_index.json', 'label.txt'])
+        # prebuilt vocab which the realtime service memory-maps at startup
+        CompactVocab.save(word_to_index, trained_model_dir)
+        # shared parameters for loading dataset
+        shared_params = {'max_len': max_len, 'ngram_size': ngram_size}
+        path = os.path.join(trained_model_dir, 'shared_params.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(shared_params, f)
+    # checkpoint after every epoch, and resume from the latest checkpoint of a previous, interrupted run
+    checkpoint_manager = CheckpointManager(checkpoint_dir, keep_last=keep_checkpoints) if checkpoint_dir else None
     start = time.time()
     train(model, trained_model_dir, train_iter=train_iter, dev_iter=dev_iter, epochs=epochs,
-          learning_rate=learning_rate, stop_patience=stop_patience, device=device)
+          learning_rate=learning_rate, stop_patience=stop_patience, device=device,
+          checkpoint_manager=checkpoint_manager)
     end = time.time()
     print('\nduration of training process: %.2f sec' % (end - start))
+    if rank == 0:
+        # TorchScript export of the best model, which loads faster than the pickled model at scoring time
+        best_model = load_model(os.path.join(trained_model_dir, 'BestModel'), map_location='cpu')
+        if prune_ngrams:
+            # keep only the used rows of the n-gram tables, the predictions are the same
+            best_model = compact_ngrams(best_model)
+            # replaced rather than overwritten, BestModel may be a link to the one of checkpoint_dir
+            path = os.path.join(trained_model_dir, 'BestModel')
+            torch.save(model_state(best_model), path + '.tmp')
+            os.replace(path + '.tmp', path)
+            print(f'compacted n-gram tables: bigram {best_model.embedding_bigram.num_embeddings} rows '
+                  f'trigram {best_model.embedding_trigram.num_embeddings} rows')
+        export_torchscript(best_model, os.path.join(trained_model_dir, TORCHSCRIPT_MODEL), max_len=max_len)
+        # and its int8 version for cpu scoring, see benchmarks/benchmark_quantized_export.py for its accuracy
+        export_quantized(best_model, os.path.join(trained_model_dir, QUANTIZED_MODEL), max_len=max_len)
+        for name in ('BestModel', TORCHSCRIPT_MODEL, QUANTIZED_MODEL):
+            size = os.path.getsize(os.path.join(trained_model_dir, name))
+            print(f'{name}: {size / 2 ** 20:.1f} MB')
+    # the other processes wait for the outputs of rank 0 before exiting
+    barrier()
     print('============================================')
 
 
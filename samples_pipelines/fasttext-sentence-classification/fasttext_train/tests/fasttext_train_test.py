@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 import unittest
 from pathlib import Path
 
@@ -9,6 +10,9 @@ from azureml.pipeline.wrapper import Module
 # The following line adds source directory to path.
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from fasttext_train import fasttext_train
+from common.utils import CompactVocab
+sys.path.insert(0, str(Path(__file__).parent.parent.parent / 'tools'))
+from launch_local import launch
 
 
 class TestFasttextTrain(unittest.TestCase):
@@ -69,3 +73,28 @@ class TestFasttextTrain(unittest.TestCase):
         # Check the existence of BestModel
         path_model = os.path.join(self.prepare_outputs()['trained_model_dir'], 'BestModel')
         self.assertTrue(os.path.exists(path_model))
+
+    def test_module_func_distributed(self):
+        paths = self.prepare_outputs()
+        for path in paths.values():
+            os.makedirs(path, exist_ok=True)
+        # This test trains data-parallel in 2 local processes from cmd line arguments.
+        args = []
+        for key, value in self.prepare_arguments().items():
+            args += [f'--{key}', str(value)]
+        script = str(Path(__file__).parent.parent / 'fasttext_train.py')
+        self.assertEqual(launch(script, args, nproc=2), [0, 0], 'Distributed training failed.')
+        # Check the existence of BestModel, written by rank 0 only
+        path_model = os.path.join(self.prepare_outputs()['trained_model_dir'], 'BestModel')
+        self.assertTrue(os.path.exists(path_model))
+
+    def test_compact_vocab_lookup(self):
+        word_to_index = {'[PAD]': 0, '[UNK]': 1, 'hello': 2, 'world': 3, 'hell': 4, '中国': 5}
+        # unknown words sharing a prefix with known ones, longer than the longest known word, and a prefix
+        words = ['hello', 'helloworld', 'hellos', 'worlds', 'hel', '中国人', '中', 'world', '']
+        with tempfile.TemporaryDirectory() as directory:
+            CompactVocab.save(word_to_index, directory)
+            vocab = CompactVocab.load(directory)
+            expected = [word_to_index.get(word, 1) for word in words]
+            self.assertEqual(vocab.lookup(words).tolist(), expected)
+            self.assertEqual([vocab.get(word, 1) for word in words], expected)
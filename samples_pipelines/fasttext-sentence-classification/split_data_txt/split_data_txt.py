@@ -1,18 +1,124 @@
 import os
 import sys
+import math
 import shutil
 import random
+import hashlib
+import tempfile
 
 from azureml.core import Run
 from azureml.pipeline.wrapper import dsl
 from azureml.pipeline.wrapper.dsl.module import ModuleExecutor, OutputDirectory, InputDirectory
 
+from common.publish import publish_files
+
+WRITE_BUFFER_SIZE = 1 << 20
+SPLIT_MODES = ('line_hash', 'index')
+
+
+def line_hash_fraction(line, salt):
+    """Stable position of a line in [0, 1), from its blake2b hash salted with the seed."""
+    digest = hashlib.blake2b(line, digest_size=8, key=str(salt).encode('ascii')).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def line_hash_assigner(ratios, salt):
+    """
+    Send a line to the first split whose cumulative ratio is above its line_hash_fraction, and to one more split
+    taking the rest otherwise: the split of a line doesn't depend on the others, duplicate lines end up in
+    the same split, and the sizes of the splits follow the ratios approximately.
+    """
+    bounds = [sum(ratios[:i + 1]) for i in range(len(ratios))]
+
+    def assign(line):
+        fraction = line_hash_fraction(line.rstrip(b'\r\n'), salt)
+        return next((i for i, bound in enumerate(bounds) if fraction < bound), len(bounds))
+    return assign
+
+
+def index_assigner(sizes, salt):
+    """
+    Selection sampling of exactly sizes[i] lines for every split, given the number of lines sum(sizes):
+    the next line goes to a split with a probability proportional to the number of lines the split still needs,
+    which draws a uniformly random split of the line indexes, seeded with salt.
+    """
+    rng = random.Random(salt)
+    remaining = list(sizes)
+
+    def assign(line):
+        draw = rng.randrange(sum(remaining))
+        for i, size in enumerate(remaining):
+            if draw < size:
+                remaining[i] -= 1
+                return i
+            draw -= size
+    return assign
+
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+def split_lines(path_input_data, paths_output, assign):
+    """
+    Stream the lines of path_input_data to the files of paths_output in one pass, the line going to
+    paths_output[assign(line)], and return the number of lines written to each of them.
+    """
+    counts = [0] * len(paths_output)
+    outputs = [open(path, 'wb', buffering=WRITE_BUFFER_SIZE) for path in paths_output]
+    try:
+        with open(path_input_data, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                i = assign(line)
+                outputs[i].write(line)
+                counts[i] += 1
+    finally:
+        for output in outputs:
+            output.close()
+    return counts
+
+
+def external_shuffle(path, seed, max_memory_mb=256):
+    """
+    Shuffle the lines of a file larger than memory in place: the lines are scattered into random bucket files
+    of about max_memory_mb each, then every bucket is shuffled in memory and appended to the output.
+    """
+    rng = random.Random(seed)
+    num_buckets = max(1, math.ceil(os.path.getsize(path) / (max_memory_mb * 2 ** 20)))
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        if num_buckets > 1:
+            bucket_paths = [os.path.join(tmp_dir, f'bucket-{i}') for i in range(num_buckets)]
+            buckets = [open(bucket_path, 'wb', buffering=WRITE_BUFFER_SIZE) for bucket_path in bucket_paths]
+            with open(path, 'rb') as f:
+                for line in f:
+                    buckets[rng.randrange(num_buckets)].write(line)
+            for bucket in buckets:
+                bucket.close()
+        else:
+            bucket_paths = [path]
+        shuffled_path = os.path.join(tmp_dir, 'shuffled')
+        with open(shuffled_path, 'wb', buffering=WRITE_BUFFER_SIZE) as output:
+            for bucket_path in bucket_paths:
+                with open(bucket_path, 'rb') as f:
+                    lines = f.readlines()
+                rng.shuffle(lines)
+                output.writelines(lines)
+        os.replace(shuffled_path, path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
 
 @dsl.module(
     name="Split Data Txt",
-    version='0.0.43',
+    version='0.0.46',
     description='Processing objects: text format dataset. Each line of the text file is a piece of data. \
-    This module divides the dataset into training dataset, validation dataset and test dataset.'
+    This module divides the dataset into training dataset, validation dataset and test dataset. \
+    By default (split_by line_hash) a line goes to a split by its hash, which keeps duplicate lines together \
+    but only approximates the ratios; split_by index gives the exact sizes of the previous versions.'
 )
 def split_data_txt(
         training_data_output: OutputDirectory(),
@@ -22,52 +128,48 @@ def split_data_txt(
         training_data_ratio=0.7,
         validation_data_ratio=0.1,
         random_split=False,
-        seed=0
+        seed=0,
+        split_by='line_hash',
+        shuffle_output=False,
+        shuffle_memory_mb=256
 ):
     print('============================================')
     print(f"value of input_dir:'{input_dir}', type of input_dir:'{type(input_dir)}'")
+    if split_by not in SPLIT_MODES:
+        raise ValueError(f'split_by should be one of {SPLIT_MODES}, got {split_by}')
     path_input_data = os.path.join(input_dir, 'data.txt')
-    with open(path_input_data, 'r', encoding='utf-8') as f:
-        data = f.readlines()
-    random.seed(seed if random_split else 0)
-    random.shuffle(data)
-    n = len(data)
+    output_dirs = [training_data_output, validation_data_output, test_data_output]
+    # data.txt is streamed rather than loaded, so that it can be larger than memory
+    salt = seed if random_split else 0
+    if split_by == 'line_hash':
+        assign = line_hash_assigner([training_data_ratio, validation_data_ratio], salt)
+    else:
+        # one more pass to count the lines, for the exact sizes
+        n = count_lines(path_input_data)
+        training_data_num = int(n * training_data_ratio)
+        dev_data_num = int(n * validation_data_ratio)
+        assign = index_assigner([training_data_num, dev_data_num, n - training_data_num - dev_data_num], salt)
+    counts = split_lines(path_input_data, [os.path.join(output_dir, 'data.txt') for output_dir in output_dirs],
+                         assign)
+    if shuffle_output:
+        # a random order of the lines within each split, for the consumers which read the files sequentially
+        for i, output_dir in enumerate(output_dirs):
+            external_shuffle(os.path.join(output_dir, 'data.txt'), seed=salt + i, max_memory_mb=shuffle_memory_mb)
+    train_num, dev_num, test_num = counts
+    total_num = sum(counts)
+    print('num of total data:', total_num)
+    print('num of training data:', train_num)
+    print('num of validation data:', dev_num)
+    print('num of test_data:', test_num)
     # for metrics
     run = Run.get_context()
-    training_data_num = int(n * training_data_ratio)
-    dev_data_num = int(n * validation_data_ratio)
-    train = data[:training_data_num]
-    dev = data[training_data_num:training_data_num + dev_data_num]
-    test = data[training_data_num + dev_data_num:]
-    print('num of total data:', len(data))
-    print('num of training data:', len(train))
-    print('num of validation data:', len(dev))
-    print('num of test_data:', len(test))
-    # for metrics
-    run.log(name='num of total data', value=len(data))
-    run.log(name='num of training data', value=len(train))
-    run.log(name='num of validation data', value=len(dev))
-    run.log(name='num of test_data', value=len(test))
-    path_label = os.path.join(input_dir, 'label.txt')
-    path_word_to_index = os.path.join(input_dir, 'word_to_index.json')
-
-    shutil.copy(src=path_label, dst=training_data_output)
-    shutil.copy(src=path_word_to_index, dst=training_data_output)
-    path = os.path.join(training_data_output, "data.txt")
-    with open(path, 'w', encoding='utf-8') as f:
-        f.writelines(train)
-
-    shutil.copy(src=path_label, dst=validation_data_output)
-    shutil.copy(src=path_word_to_index, dst=validation_data_output)
-    path = os.path.join(validation_data_output, "data.txt")
-    with open(path, 'w', encoding='utf-8') as f:
-        f.writelines(dev)
-
-    shutil.copy(src=path_label, dst=test_data_output)
-    shutil.copy(src=path_word_to_index, dst=test_data_output)
-    path = os.path.join(test_data_output, "data.txt")
-    with open(path, 'w', encoding='utf-8') as f:
-        f.writelines(test)
+    run.log(name='num of total data', value=total_num)
+    run.log(name='num of training data', value=train_num)
+    run.log(name='num of validation data', value=dev_num)
+    run.log(name='num of test_data', value=test_num)
+    # the three outputs share the labels and the vocab of the input, as links rather than copies when possible
+    for output_dir in output_dirs:
+        publish_files(input_dir, output_dir, ['label.txt', 'word_to_index.json'])
     print('============================================')
 
 
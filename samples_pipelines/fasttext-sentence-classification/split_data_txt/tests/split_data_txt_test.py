@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 import unittest
 from pathlib import Path
 
@@ -36,7 +37,9 @@ class TestSplitDataTxt(unittest.TestCase):
             'training_data_ratio': 0.7,
             'validation_data_ratio': 0.1,
             'random_split': False,
-            'seed': 123
+            'seed': 123,
+            # exact split sizes, which test_module_func checks
+            'split_by': 'index'
         }
 
     def prepare_arguments(self) -> dict:
@@ -85,3 +88,34 @@ class TestSplitDataTxt(unittest.TestCase):
         self.assertEqual(num_train, expected_num_train)
         self.assertEqual(num_validation, expected_num_validation)
         self.assertEqual(num_test, expected_num_test)
+
+    def test_line_hash_split(self):
+        # the default split_by keeps duplicate lines in the same split, with sizes close to the ratios
+        training_data_ratio, validation_data_ratio = 0.7, 0.1
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_dir = os.path.join(tmp_dir, 'input')
+            os.makedirs(input_dir)
+            with open(os.path.join(input_dir, 'data.txt'), 'w', encoding='utf-8') as f:
+                for i in range(3000):
+                    f.write(f'sentence {i}\t{i % 3}\n' * (1 + i % 3))
+            for name in ('label.txt', 'word_to_index.json'):
+                with open(os.path.join(input_dir, name), 'w', encoding='utf-8') as f:
+                    f.write('{}' if name.endswith('.json') else '0\n1\n2\n')
+            outputs = {name: os.path.join(tmp_dir, name)
+                       for name in ('training_data_output', 'validation_data_output', 'test_data_output')}
+            for path in outputs.values():
+                os.makedirs(path)
+
+            split_data_txt(input_dir=input_dir, training_data_ratio=training_data_ratio,
+                           validation_data_ratio=validation_data_ratio, **outputs)
+            splits = [open(os.path.join(outputs[name], 'data.txt'), encoding='utf-8').readlines()
+                      for name in ('training_data_output', 'validation_data_output', 'test_data_output')]
+
+        num_total = sum(len(lines) for lines in splits)
+        self.assertEqual(num_total, 6000)
+        for i, lines in enumerate(splits):
+            for j, other in enumerate(splits[i + 1:], i + 1):
+                self.assertFalse(set(lines) & set(other), f'duplicate lines in splits {i} and {j}')
+        test_data_ratio = 1 - training_data_ratio - validation_data_ratio
+        for lines, ratio in zip(splits, [training_data_ratio, validation_data_ratio, test_data_ratio]):
+            self.assertAlmostEqual(len(lines) / num_total, ratio, delta=0.03)
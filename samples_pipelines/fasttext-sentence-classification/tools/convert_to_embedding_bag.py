@@ -0,0 +1,32 @@
+"""
+Convert a trained FastText checkpoint (e.g. the BestModel of fasttext_train) into a FastTextBag model
+with the same weights.
+
+    python tools/convert_to_embedding_bag.py --model trained_model_dir/BestModel --output trained_model_dir/BestModel
+"""
+import sys
+import argparse
+from pathlib import Path
+
+import torch
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from common.FastText import FastTextBag
+from common.checkpoint import load_model, model_state
+
+
+def main():
+    parser = argparse.ArgumentParser("convert_to_embedding_bag")
+    parser.add_argument("--model", type=str, help="Path of the FastText checkpoint")
+    parser.add_argument("--output", type=str, help="Path of the converted FastTextBag checkpoint")
+    args = parser.parse_args()
+
+    model = load_model(args.model, map_location='cpu')
+    bag = FastTextBag.from_fasttext(model)
+    torch.save(model_state(bag), args.output)
+    print(f'converted {args.model} into {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Run a script in several local CPU processes, with the environment variables (RANK, WORLD_SIZE, MASTER_ADDR, ...)
+which common.distributed.init_distributed reads, e.g. to try the data-parallel training of fasttext_train:
+
+    python tools/launch_local.py --nproc 2 fasttext_train/fasttext_train.py \
+        --training_data_dir <dir> --validation_data_dir <dir> --trained_model_dir <dir>
+"""
+import os
+import sys
+import socket
+import argparse
+import subprocess
+from pathlib import Path
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch(script, script_args, nproc=2):
+    """Run python script script_args in nproc processes of one process group, returns the exit codes."""
+    port = str(free_port())
+    # the script imports common from the source directory, as in AzureML
+    source_dir = str(Path(__file__).parent.parent)
+    python_path = os.pathsep.join([source_dir, os.environ['PYTHONPATH']]) if 'PYTHONPATH' in os.environ \
+        else source_dir
+    processes = []
+    for rank in range(nproc):
+        env = dict(os.environ, RANK=str(rank), WORLD_SIZE=str(nproc), LOCAL_RANK=str(rank),
+                   LOCAL_WORLD_SIZE=str(nproc), MASTER_ADDR='127.0.0.1', MASTER_PORT=port, PYTHONPATH=python_path)
+        processes.append(subprocess.Popen([sys.executable, script] + list(script_args), env=env))
+    return [process.wait() for process in processes]
+
+
+def main():
+    parser = argparse.ArgumentParser("launch_local")
+    parser.add_argument("--nproc", type=int, default=2, help="Number of processes")
+    parser.add_argument("script", type=str, help="Path of the script to run")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments of the script")
+    args = parser.parse_args()
+
+    exit_codes = launch(args.script, args.script_args, args.nproc)
+    print(f'exit codes: {exit_codes}')
+    sys.exit(max(exit_codes, key=abs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+Preprocess the data.txt of a data directory into contiguous .npy arrays (ids, bigram, trigram, labels).
+When the output is written next to data.txt, the train and evaluation modules memory-map the arrays
+instead of parsing the text.
+
+    python tools/preprocess_dataset.py --data_dir split_data_txt/data/... --max_len 32 --ngram_size 200000
+"""
+import sys
+import argparse
+from pathlib import Path
+
+# The following line adds source directory to path.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from common.utils import get_vocab, get_id_label, preprocess_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser("preprocess_dataset")
+    parser.add_argument("--data_dir", type=str, help="Directory of data.txt, word_to_index.json and label.txt")
+    parser.add_argument("--output_dir", type=str, default=None, help="Defaults to data_dir")
+    parser.add_argument("--max_len", type=int, default=32)
+    parser.add_argument("--ngram_size", type=int, default=200000)
+    args = parser.parse_args()
+
+    data_dir = Path(args.data_dir)
+    word_to_index = get_vocab(data_dir / 'word_to_index.json')
+    map_id_label, map_label_id = get_id_label(data_dir / 'label.txt')
+    dataset = preprocess_dataset(data_dir, args.output_dir or data_dir, word_to_index, map_label_id,
+                                 max_len=args.max_len, ngram_size=args.ngram_size)
+    print(f'preprocessed {len(dataset)} samples into {args.output_dir or data_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -623,3 +623,117 @@ def qcs_unique_id_from(qcs_line: str):
     fields = qcs_line.split('\t')
     if fields:
         return fields[0]
+
+
+def parse_evaluation_ids(unique_ids, qcs=False):
+    """
+    Columnar counterpart of extract_email_id and extract_char_position.
+    Parses a whole column of emailNumber-charPos ids (dummyQuery-emailNumber-charPos ids if qcs is True)
+    at once with numpy string operations instead of calling split('-') on every id.
+
+    An id follows the same validity rules as in extract_email_id and extract_char_position,
+    and additionally each field has to be a non-negative integer of ASCII digits that fits in an int64.
+    Fields that can't be parsed are set to -1.
+
+    Arguments:
+        unique_ids {iterable of str} -- evaluation point ids
+        qcs {bool} -- whether the ids are in QCS format
+    Returns:
+        Tuple (email ids {np.ndarray of int64}, char positions {np.ndarray of int64})
+    """
+    # a list first, np.asarray would make a single 0-d object out of a generator
+    ids = np.asarray(unique_ids if isinstance(unique_ids, np.ndarray) else list(unique_ids), dtype=str)
+    email_ids = np.full(ids.shape, -1, dtype=np.int64)
+    char_positions = np.full(ids.shape, -1, dtype=np.int64)
+    if ids.size == 0:
+        return email_ids, char_positions
+
+    valid = np.char.count(ids, '-') == (2 if qcs else 1)
+    if qcs:
+        valid &= np.char.startswith(ids, Constants.QUERY_QCS)
+
+    # "a-b-c".rpartition('-') gives ("a-b", "-", "c"), so the char position is always the last field
+    fields = np.char.rpartition(ids, '-')
+    email_field = fields[..., 0]
+    char_position_field = fields[..., 2]
+    if qcs:
+        email_field = np.char.rpartition(email_field, '-')[..., 2]
+
+    valid_email_ids = valid & _is_int64_field(email_field)
+    valid_char_positions = valid & _is_int64_field(char_position_field)
+    email_ids[valid_email_ids] = email_field[valid_email_ids].astype(np.int64)
+    char_positions[valid_char_positions] = char_position_field[valid_char_positions].astype(np.int64)
+    return email_ids, char_positions
+
+
+INT64_MAX_DIGITS = str(np.iinfo(np.int64).max)
+
+
+def _is_int64_field(fields):
+    """
+    Mask of the fields made of ASCII digits only (np.char.isdecimal also accepts other scripts' digits)
+    whose value fits in an int64.
+    """
+    # stripping the digits from both ends only leaves an empty string if there is nothing else
+    digits_only = (np.char.str_len(fields) > 0) & (np.char.strip(fields, '0123456789') == '')
+    significant = np.char.lstrip(fields, '0')
+    length = np.char.str_len(significant)
+    # digit strings of the same length compare like the numbers they represent
+    fits = (length < len(INT64_MAX_DIGITS)) | ((length == len(INT64_MAX_DIGITS)) & (significant <= INT64_MAX_DIGITS))
+    return digits_only & fits
+
+
+def qcs_unique_ids_from(qcs_lines):
+    """
+    Columnar counterpart of qcs_unique_id_from.
+    Only the text before the first tab of each line is kept, the remaining fields are never split.
+
+    Arguments:
+        qcs_lines {iterable of str} -- lines of the QCS query label tool output
+    Returns:
+        first field of every line {np.ndarray of str}
+    """
+    lines = np.asarray(qcs_lines, dtype=str)
+    if lines.size == 0:
+        return lines
+    return np.char.partition(lines, '\t')[..., 0]
+
+
+def parse_qcs_output_file(qcs_file, encoding='utf-8'):
+    """
+    Parse the email ids and char positions of every line in a QCS query label tool output file.
+    Lines are kept aligned with the file, so lines that can't be parsed get -1 in both arrays.
+
+    Arguments:
+        qcs_file {str} -- path to the QCS output file
+        encoding {str} -- encoding of the file, undecodable bytes are replaced
+    Returns:
+        Tuple (email ids {np.ndarray of int64}, char positions {np.ndarray of int64})
+    """
+    # lines end at '\n' only, unlike str.splitlines and universal newlines, whose other line boundaries
+    # (e.g. '\r' or U+2028) may occur in the free-text columns
+    with open(qcs_file, 'r', encoding=encoding, errors='replace', newline='\n') as f:
+        lines = [line.rstrip('\r\n') for line in f]
+    return parse_evaluation_ids(qcs_unique_ids_from(lines), qcs=True)
+
+
+def group_by_email_id(email_ids):
+    """
+    Group evaluation points by email id with a sort-based index instead of a dict of lists.
+    The evaluation points of unique_email_ids[i] are at positions order[offsets[i]:offsets[i + 1]],
+    in their original relative order.
+
+    Arguments:
+        email_ids {array-like of int} -- email id of every evaluation point, e.g. from parse_evaluation_ids
+    Returns:
+        Tuple (unique_email_ids {np.ndarray}, order {np.ndarray}, offsets {np.ndarray})
+    """
+    email_ids = np.asarray(email_ids, dtype=np.int64)
+    order = np.argsort(email_ids, kind='stable')
+    if email_ids.size == 0:
+        return email_ids, order, np.zeros(1, dtype=np.int64)
+
+    sorted_email_ids = email_ids[order]
+    boundaries = np.flatnonzero(sorted_email_ids[1:] != sorted_email_ids[:-1]) + 1
+    offsets = np.concatenate(([0], boundaries, [sorted_email_ids.size])).astype(np.int64)
+    return sorted_email_ids[offsets[:-1]], order, offsets